@@ -3,6 +3,17 @@ import numpy as np
 import io
 import time
 import os
+import threading
+import queue
+
+# every array saved in the .npy format (np.save) starts with this string
+npyMagic = b'\x93NUMPY'
+
+# connection settings used by Database and sqliteUtils.openDB, run together with executescript
+# synchronous = NORMAL with write-ahead logging avoids a full sync of the journal on every commit
+# keep temporary tables in memory, use a 64 MB page cache (negative values are in kB), and memory map up to
+#   256 MB of the file so reads (i.e. post analysis) do not need to copy pages into the cache
+connectionPragmas = "PRAGMA synchronous = NORMAL; PRAGMA temp_store = MEMORY; PRAGMA cache_size = -65536; PRAGMA mmap_size = 268435456;"
 
 # Class for creating/saving into SQlite Database during ultrasound experiments
 # Contains functions for initializing databases, saving experimental parameters, and reformatting/saving data from dictionaries
@@ -20,9 +31,33 @@ class Database:
         else:
             fileName = params['fileName'] + '.sqlite3'
 
-        self.connection = sqlite3.connect(fileName)
+        # check_same_thread is disabled since queued data is written from a background thread (see flushData)
+        # isolation_level = None turns off the implicit transactions of the sqlite3 module. Single writes are committed
+        #   immediately and writeRows() opens its own transaction for each batch
+        self.connection = sqlite3.connect(fileName, check_same_thread = False, isolation_level = None)
         self.cursor = self.connection.cursor()
 
+        # write-ahead logging with synchronous = NORMAL avoids a full sync of the rollback journal on every commit
+        # the database is still safe if the program crashes, only the most recent commits can be lost on a power failure
+        # journal_mode returns the mode that was set, so it is run on its own to check that WAL was enabled
+        if self.cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0] != 'wal':
+            print("Database Warning: unable to enable write-ahead logging, writes will be slower.")
+        self.cursor.executescript(connectionPragmas)
+
+        # rows waiting to be written by flushData(). queueData() stores the query and a list of value lists
+        # the data is automatically flushed once bufferSize rows are waiting
+        self.bufferSize = 500
+        self.bufferQuery = None
+        self.bufferVals = []
+
+        # background thread that writes the batches from flushData() so that data collection can continue during the write
+        # it is only started by the first flushData() call, so experiments that only use writeData() never start it
+        self.writeQueue = queue.Queue()
+        self.writeThread = None
+        self.writeError = None
+        # both threads share the connection, so writes hold this lock to keep a write() from landing inside a batch transaction
+        self.writeLock = threading.Lock()
+
         # register adapters for converting between numpy arrays and text
         # modified from https://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
         # Converts np.array to TEXT when inserting
@@ -46,25 +81,40 @@ class Database:
         #create data table
         self.cursor.execute(dataTableInit)
 
+        # secondary indices are created by close() once all the data is written, rather than with the table. Building an
+        #   index in one pass at the end is much faster than updating it on every insert
+        self.indexQueries = self.indexInitializer(params)
+
     # define adapters for converting numpy arrays to sqlite-usable format
-    # copied from stackoverflow: https://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
+    # 1D float arrays (i.e. voltage and time) are saved as the raw bytes of a float32 array. This is half the size of float64
+    #   and is read back with np.frombuffer without parsing a header
+    # all other arrays are saved in the .npy format, which older databases also used for the 1D float arrays
+    # .npy format adapter copied from stackoverflow: https://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
     @staticmethod
     def adaptArray(arr):
         """
         http://stackoverflow.com/a/31312102/190597 (SoulNibbler)
         """
+        if arr.ndim == 1 and arr.dtype.kind == 'f':
+            return sqlite3.Binary(np.ascontiguousarray(arr, dtype = np.float32).tobytes())
+
         out = io.BytesIO()
         np.save(out, arr)
         out.seek(0)
         return sqlite3.Binary(out.read())
 
     # define adapters for converting numpy arrays to sqlite-usable format
+    # .npy data is recognized by its magic string, anything else is raw float32 data from adaptArray
+    # float32 data is returned as float64 so analysis on old and new databases gives arrays of the same type
     # copied from stackoverflow: https://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
     @staticmethod
     def convertArray(text):
-        out = io.BytesIO(text)
-        out.seek(0)
-        return np.load(out)
+        if text.startswith(npyMagic):
+            out = io.BytesIO(text)
+            out.seek(0)
+            return np.load(out)
+
+        return np.frombuffer(text, dtype = np.float32).astype(np.float64)
 
     # Generates an SQL query string to intialize the data table based on the experiment function
     def dataTableInitializer(self, params : dict):
@@ -94,6 +144,15 @@ class Database:
 
         return initTable + ')'
 
+    # Generates a list of SQL queries to create the secondary indices on the data table based on the experiment function
+    # Scans are indexed on their coordinates, which are used to look up pixels during analysis
+    def indexInitializer(self, params : dict):
+
+        if params['experiment'] == 'single scan' or params['experiment'] == 'multi scan':
+            return ['CREATE INDEX IF NOT EXISTS acoustics_coordinates ON acoustics (' + params['primaryAxis'] + ', ' + params['secondaryAxis'] + ')']
+
+        return []
+
     # helper function to generate initialization strings for the different voltages dependent on the experiment parameters
     def generateVoltageString(self, params):
 
@@ -198,8 +257,8 @@ class Database:
     # outputs the cursor at the end of the table
     def write(self, query: str, vals: list):
 
-        self.cursor.execute(query, vals)
-        self.connection.commit()
+        with self.writeLock:
+            self.cursor.execute(query, vals)
 
         return self.cursor.lastrowid
 
@@ -208,4 +267,114 @@ class Database:
     def writeData(self, dataDict, table : str = 'acoustics'):
 
         query, vals = self.parseQuery(dataDict, table)
-        self.write(query, vals)
\ No newline at end of file
+        self.write(query, vals)
+
+    # buffered version of writeData for experiments that collect many rows quickly (i.e. scans)
+    # rows are held in memory and written together by flushData() in a single transaction, which is much faster than
+    #   committing every row. Call flushData() at convenient points (i.e. the end of a scan line) and close() at the end
+    def queueData(self, dataDict, table : str = 'acoustics'):
+
+        query, vals = self.parseQuery(dataDict, table)
+
+        # executemany needs every row to use the same query, so write out what is waiting if the columns change
+        if query != self.bufferQuery:
+            self.flushData()
+            self.bufferQuery = query
+
+        self.bufferVals.append(vals)
+
+        if len(self.bufferVals) >= self.bufferSize:
+            self.flushData()
+
+    # sends all rows waiting from queueData() to the background write thread and returns immediately
+    # the rows are then written in a single transaction by writeRows()
+    def flushData(self):
+
+        # raise any error from the write thread here so the experiment stops instead of silently losing data
+        if self.writeError is not None:
+            raise self.writeError
+
+        if len(self.bufferVals) == 0:
+            return
+
+        if self.writeThread is None:
+            self.writeThread = threading.Thread(target = self.writeLoop, daemon = True)
+            self.writeThread.start()
+
+        self.writeQueue.put((self.bufferQuery, self.bufferVals))
+        self.bufferVals = []
+
+    # runs on the background write thread. Writes batches from writeQueue until the None sent by close() is received
+    def writeLoop(self):
+
+        writeCursor = self.connection.cursor()
+
+        while True:
+            batch = self.writeQueue.get()
+            if batch is None:
+                return
+
+            # any error (not only sqlite3.Error, i.e. from an adapter) is stored, so close() raises it instead of returning
+            #   as if the queued rows had been written
+            try:
+                self.writeRows(writeCursor, batch[0], batch[1])
+            except Exception as error:
+                print(f"Database.writeLoop: Error writing data to database: {error}")
+                self.writeError = error
+                return
+
+    # writes a list of rows in a single transaction
+    # rows are inserted several at a time with a multi-row INSERT ... VALUES (?,..), (?,..), ... query, which is faster
+    #   than inserting them one by one. Leftover rows that do not fill a whole multi-row query are written with executemany
+    # BEGIN IMMEDIATE takes the write lock at the start of the transaction rather than upgrading to it on the first insert
+    def writeRows(self, cursor, query : str, rowVals : list):
+
+        numRows = len(rowVals)
+
+        # older versions of sqlite limit a query to 999 variables, so that sets the number of rows per query
+        rowsPerQuery = max(1, 999 // len(rowVals[0]))
+        fullQueries = numRows // rowsPerQuery
+        multiRowQuery = self.multiRowQuery(query, rowsPerQuery)
+
+        with self.writeLock:
+            cursor.execute("BEGIN IMMEDIATE")
+            # a failed batch is rolled back, so the shared connection is not left holding the write lock in an open transaction
+            try:
+                for i in range(fullQueries):
+                    rows = rowVals[i * rowsPerQuery : (i + 1) * rowsPerQuery]
+                    # flatten the rows into a single list of values to match the query
+                    cursor.execute(multiRowQuery, [val for row in rows for val in row])
+
+                cursor.executemany(query, rowVals[fullQueries * rowsPerQuery:])
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+
+    # converts a single row INSERT query from parseQuery into one that inserts numRows rows at once
+    # i.e. 'INSERT INTO acoustics (a, b) VALUES (?,?);' to 'INSERT INTO acoustics (a, b) VALUES (?,?),(?,?);' for numRows = 2
+    @staticmethod
+    def multiRowQuery(query : str, numRows : int):
+
+        insertString, qMarks = query.removesuffix(';').split(' VALUES ')
+
+        return insertString + ' VALUES ' + ",".join([qMarks] * numRows) + ';'
+
+    # writes any remaining queued data, waits for the write thread to finish, creates the indices, and closes the connection
+    def close(self):
+
+        self.flushData()
+
+        if self.writeThread is not None:
+            self.writeQueue.put(None)
+            self.writeThread.join()
+
+        # only build the indices if all the data was written
+        if self.writeError is None:
+            for indexQuery in self.indexQueries:
+                self.cursor.execute(indexQuery)
+
+        self.connection.close()
+
+        if self.writeError is not None:
+            raise self.writeError
@@ -29,7 +29,6 @@ from typing import Callable
 from tqdm import tqdm
 from matplotlib import get_backend
 from matplotlib import pyplot as plt
-from matplotlib import colormaps as cmp
 import time
 import numpy as np
 import os
@@ -79,21 +78,21 @@ def sqliteToPickle(file : str):
     res = cur.execute(selectQuery)
 
     # Iterate through the result, convert the data to numpy arrays, apply the function, record in a list with keys
-    for i in tqdm(range(numRows)):
-
-        row = res.fetchone()
-
-        #create a new dict for the given collection_index
-        index = int(row[indexPosition])
-        dataDict[index] = {}
-
-        for i in range(len(colNames)):
-            # some tables have blank columns due to code bugs. This skips over them
-            # needs to first check if the value is an array b/c truth values don't apply to whole arrays
-            if type(row[i]) == np.ndarray or row[i] != None:
-                dataDict[index][colNames[i]] = squ.stringConverter(row[i])
-            else:
-                pass
+    # rows are fetched in chunks (see squ.fetchChunks), which is much faster than fetching them one by one
+    for rows in squ.fetchChunks(res, numRows):
+        for row in rows:
+
+            #create a new dict for the given collection_index
+            index = int(row[indexPosition])
+            dataDict[index] = {}
+
+            for i in range(len(colNames)):
+                # some tables have blank columns due to code bugs. This skips over them
+                # needs to first check if the value is an array b/c truth values don't apply to whole arrays
+                if type(row[i]) == np.ndarray or row[i] != None:
+                    dataDict[index][colNames[i]] = squ.stringConverter(row[i])
+                else:
+                    pass
 
     # extract the experimental parameters from the sql table
     paramNames = squ.columnNames(cur, 'parameters')
@@ -258,7 +257,7 @@ def combineRepeatPulseData(dataList, saveName : str):
         print("Adding data from " + orderedData[i]['fileName'] + '...')
         # write new dict by updating the indices
         # the collection_index of newData is extended by the value of startIndices
-        for j in tqdm(range(endIndices[i])):
+        for j in tqdm(range(endIndices[i]), miniters = max(1, endIndices[i] // 1000), mininterval = 0.5):
             newData[startIndices[i] + j] = orderedData[i][j]
 
     # generate fileName for the new pickle
@@ -720,26 +719,8 @@ def multiScanDataAtPixels(fileNames : list, dataKeys : list, coordinates : list)
         dataDictList.append(scanDataAtPixels(fileData, dataKeys, coordinates))
 
     print("\nMerging data...")
-    # Merge data. storage list is a list of dicts of dicts. This got ugly...
-    # First make a copy of dataDictList[0] but with the values as numpy arrays
-    masterDict = {}
-
-    for coordinate, coordinateData in dataDictList[0].items():
-        masterDict[coordinate] = {dataColumn: np.array(value) for dataColumn, value in coordinateData.items()}
-
-    # Now iterate through the rest of dataDictList, merging the values into the arrays of masterDict
-    for scan in dataDictList[1:]:
-
-        # for each scan in list, iterate through the keys (coordinates) and values (values == innerDict of data columns)
-        for coor, coordinateData in scan.items():
-
-            # append the data values for the scan to the masterdict
-            for dataColumn, value in coordinateData.items():
-                # Arrays must be handles differently from individual values - they should be 'stacked' rather than appended
-                if type(value) == np.ndarray:
-                    masterDict[coor][dataColumn] = np.vstack((masterDict[coor][dataColumn], value))
-                else:
-                    masterDict[coor][dataColumn] = np.append(masterDict[coor][dataColumn], value)
+    # Merge data. storage list is a list of dicts of dicts
+    masterDict = squ.mergeScanData(dataDictList)
 
     return masterDict
 
@@ -863,18 +844,14 @@ def plotWaveformOverTimeAtCoor(dirName : str, coor : tuple, xDat = 'time', yDat
     # gather a dict of the data. Since we are only gathering at one coordinate, we use that to collect the data dict from that key
     dataDict = directoryScanDataAtPixels(dirName, [xDat, yDat, 'time_collected'], [coor])[coor]
 
-    # convert time_collected to a common zero, then normalize it to [0,1] for the colormap
+    # convert time_collected to a common zero in hours for the colormap
     timesCollected = dataDict['time_collected']
     minTime = min(timesCollected)
     timesCollectZeroRef = timesCollected - minTime
-    maxTime = max(timesCollectZeroRef)
-    normTime = timesCollectZeroRef / maxTime
 
-    for wave in range(len(dataDict['time_collected'])):
-        plt.plot(dataDict[xDat][wave], dataDict[yDat][wave], c = cmp['viridis'](normTime[wave]), label = round(timesCollectZeroRef[wave]/3600, 2))
+    # the waveforms are drawn as one LineCollection with a colorbar, since a legend becomes too crowded for 100+ curves
+    squ.plotColormappedWaveforms(dataDict[xDat], dataDict[yDat], timesCollectZeroRef/3600, "Time (h)")
 
-    # legend becomes too crowded for 100+ curves
-    # plt.legend()
     plt.show()
 
 
@@ -1017,12 +994,13 @@ def plotScanDataAtCoorsVsTime(dirName : str, dataKey : str, coors : list, normal
             # be wary of issues with copy and references here - may need to revise
             dataDict[coor][dataKey] = dataDict[coor][dataKey]/normValue
 
-    for coor in dataDict.keys():
-        # Convert to common 0 by subtracting start time. Divide by 3600 to display in hours instead of seconds
-        timeDat = (dataDict[coor]['time_collected'] - t0) / 3600
-        plt.scatter(timeDat, dataDict[coor][dataKey], label = str(coor))
+    # all coordinates are drawn with one scatter call (see squ.scatterGroups)
+    plotCoors = list(dataDict.keys())
+    # Convert to common 0 by subtracting start time. Divide by 3600 to display in hours instead of seconds
+    timeDat = (np.concatenate([dataDict[coor]['time_collected'] for coor in plotCoors]) - t0) / 3600
+    valueDat = np.concatenate([dataDict[coor][dataKey] for coor in plotCoors])
+    squ.scatterGroups(timeDat, valueDat, [len(dataDict[coor][dataKey]) for coor in plotCoors], [str(coor) for coor in plotCoors])
 
-    plt.legend()
     plt.show()
 
 # Plot a data key that contains a list of coordinates and plot it vs another data key
@@ -1086,7 +1064,7 @@ def plotDataInBox(dir, dataKeys, topLeft, bottomRight, steps, xErr = False, yErr
         plt.errorbar(dataInBox[dataKeys[0]]['mean'], dataInBox[dataKeys[1]]['mean'], yerr = yErrList, xerr = xErrList, fmt = "o")
 
     else:
-        plt.scatter(dataInBox[dataKeys[0]]['mean'], dataInBox[dataKeys[1]]['mean'])
+        plt.plot(dataInBox[dataKeys[0]]['mean'], dataInBox[dataKeys[1]]['mean'], 'o')
 
     plt.show()
 
@@ -1104,7 +1082,7 @@ def plotDataInBoxVsTime(dir, dataKey, topLeft, bottomRight, steps, yErr = False)
         plt.errorbar(formattedTime, dataInBox[dataKey]['mean'], yerr = yErrList, fmt = "o")
 
     else:
-        plt.scatter(formattedTime, dataInBox[dataKey]['mean'])
+        plt.plot(formattedTime, dataInBox[dataKey]['mean'], 'o')
 
     plt.show()
 
@@ -1134,7 +1112,7 @@ def plotRepeatPulseDataVsTime(dataDict, dataKey):
             data = np.append(data, dataDict[index][dataKey])
 
     time = timeCollectedToExperimentHours(rawTime)
-    plt.scatter(time, data)
+    plt.plot(time, data, 'o')
     plt.show()
 
 ##############################################################################3
@@ -1305,10 +1283,10 @@ def envelopeThresholdTOF(yDat, xDat, threshold = 0.5, linearInterpolation = True
     else:
         return xDat[firstBreakIndex]
 
-# Calculates the hilbert envelope of an input signal by taking the absolute value of the hilbert transform
+# Calculates the hilbert envelope of an input signal, the absolute value of the analytic signal (see squ.analyticEnvelope)
 def hilbertEnvelope(array):
 
-    return np.abs(scipy.signal.hilbert(array))
+    return squ.analyticEnvelope(np.asarray(array))
 
 # helper function that returns the index of the first value in the input array that exceeds a given threshold
 # Used to pick first break data
@@ -1912,7 +1890,7 @@ class DataCube():
         fitY = fitFunc(fitX, *fitParams)
 
         # make plots
-        plt.scatter(xData, yData, c = 'orange')
+        plt.plot(xData, yData, 'o', color = 'orange')
         plt.plot(fitX, fitY)
         plt.show()
 
@@ -20,6 +20,22 @@ import math
 from picosdk.functions import adc2mV, assert_pico_ok
 import mux
 
+# voltage limits (in V) of the picoscope voltage ranges, taken from API ps2000aSetChannel() documentation
+# used by Picoscope.voltageRangeFinder. Defined once here rather than on every call since the range finder runs at every pixel
+picoVoltageLimits = np.array([0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20])
+
+# tolerance limit for the range finder - change limit if max is within 5%
+rangeTolerance = 0.95
+picoVoltageTolerances = rangeTolerance * picoVoltageLimits
+
+# the same limits and tolerances in mV, the units returned by runRapidBlock, so measured peaks can be compared without rescaling
+picoVoltageLimitsmV = 1000 * picoVoltageLimits
+picoVoltageTolerancesmV = 1000 * picoVoltageTolerances
+
+# number of waves averaged in the preview measurements voltageRangeFinder uses while searching for a range that fits
+# the peak only needs to be roughly known to pick a range, so these are much shorter than a full measurement
+rangeFinderPreviewWaves = 32
+
 # Explanation of measurement process:
 # 1) Picoscope object created using experimental parameters. This establishes the connection to the picoscope
 #   -> This is only run once per experiment
@@ -52,6 +68,24 @@ class Picoscope():
         self.params = params
         self.pulser = pulser
 
+        # settings used in the most recent setupPicoMeasurement call. Used to skip resending unchanged settings to the scope
+        self.lastSetupKey = None
+
+        # memory buffer that receives the rapid block data. This is reused between measurements and only reallocated
+        #   when the number of waves or samples changes (see setupCaptureBuffers)
+        self.bufferArrayChannelA = None
+
+        # (waves, samples) used the last time the memory segments and data buffers were registered with the scope
+        # the scope keeps these between captures, so they are only resent when the capture size changes
+        self.lastCaptureKey = None
+
+        # number of captures last set with ps2000aSetNoOfCaptures. This can be less than the number of segments
+        #   for the shorter preview measurements used by voltageRangeFinder
+        self.numberOfCaptures = None
+
+        # maximum ADC count of the scope, used to convert to mV. This is fixed for a given scope so it is only queried once
+        self.maxADC = None
+
         self.openPicoscope()
         # self.setupPicoMeasurement(measureDelay, voltageRangeT, voltageRangeP, samples, measureTime, collectionDirection)
 
@@ -121,6 +155,17 @@ class Picoscope():
         self.samples = self.params['samples']
         measureTime = self.params['measureTime']
 
+        # channel and trigger settings persist on the picoscope between measurements, so if nothing has changed since the
+        #   last setup the USB calls to set channels and triggers can be skipped
+        # echo settings depend on the offset and pulser gain for the given direction rather than the voltage range
+        if mode == 'echo':
+            rangeSettings = (self.params['voltageOffset' + direction.title()], self.params['gain' + direction.title()])
+        else:
+            rangeSettings = voltageRange
+        setupKey = (mode, direction, measureDelay, self.samples, measureTime, rangeSettings)
+        if setupKey == self.lastSetupKey:
+            return
+
         # set mode-dependent parameters: voltageIndex and voltageOffset
         # voltageIndex: get voltage indices from input voltage ranges for transmission measurement
         #   pulse-echo should be set to 1 V (index = 6) since the signal is optimized by pulser gain instead
@@ -150,6 +195,8 @@ class Picoscope():
         if setErrorCheck == -1:
             assert_pico_ok(self.setChA)
 
+        self.lastSetupKey = setupKey
+
     # helper function to convert an input voltage range to the index used in setChannel()
     def voltageIndexFromRange(self, voltageRange):
 
@@ -203,12 +250,50 @@ class Picoscope():
             assert_pico_ok(self.trigger)
         return 0
 
+    # helper function for runRapidBlock that divides the picoscope memory into segments for each wave and registers the
+    #   numpy buffer that receives the data from channel A
+    # Channel B only carries the trigger and its data is never used, so no buffer is registered for it. This way
+    #   ps2000aGetValuesBulk only transfers the channel A data
+    def setupCaptureBuffers(self, numberOfWaves, cNumberOfSamples):
+
+        #Divide picoscope memory into segments for rapidblock capture(Important)
+        memorySegments = ps.ps2000aMemorySegments(self.cHandle, numberOfWaves, ctypes.byref(cNumberOfSamples))
+        assert_pico_ok(memorySegments)
+
+        # the number of captures is reset along with the segments
+        self.numberOfCaptures = None
+
+        #Set up memory buffer to receive data from channel A
+        #The buffer is kept between measurements so a scan does not allocate a new (waves x samples) array at every pixel
+        self.bufferArrayChannelA = np.empty((numberOfWaves, self.samples), dtype = ctypes.c_int16)
+
+        bufferArrayChannelA = self.bufferArrayChannelA
+
+        #Convert the buffer to ctypes. This shares memory with the numpy array rather than copying it
+        bufferArrayChannelACtype = np.ctypeslib.as_ctypes(bufferArrayChannelA)
+
+        # bufferArrayChannelBPointer = bufferArrayChannelB.ctypes.data_as(c_int16_pointer)
+        for wave in range(numberOfWaves):
+            # bufferArrayChannelB[wave] = (ctypes.c_int16 * numberOfSamples)()
+            # dataPointer = bufferArrayChannelB[wave].ctypes.data_as(c_int16_pointer)
+            # Setting the data buffer location for data collection from channel A
+            # handle = chandle
+            # source = ps2000a_channel_A = 0
+            # Buffer location = ctypes.byref(bufferArrayChannelA[wave])
+            # Buffer length = numberOfSampless
+            # Segment index = wave
+            # Ratio mode = ps2000a_Ratio_Mode_None = 0 (we are not downsampling)
+            waveC = ctypes.c_uint32(wave)
+            dataBufferA = ps.ps2000aSetDataBuffer(self.cHandle, 0, ctypes.byref(bufferArrayChannelACtype[wave]), self.samples, waveC, 0)
+            assert_pico_ok(dataBufferA)
+
     # runPicoMeasurement runs a rapidblock measurement on the picoscope and returns the waveform data
     # Runs measurement based on parameters in self.params. Inputs a multiplexer object, a direction, and a mode
     #   If no multiplexer is used (multiplexer = None) these inputs are ignored. Otherwise, the multiplexer is configured
     #   before running the experiment
+    # waves is the number of waves to average. It defaults to params['waves'] and cannot be larger than that
     # Returns an array of voltages and an array of times
-    def runRapidBlock(self, multiplexer = None, mode = 'transmission', direction = 'forward'):
+    def runRapidBlock(self, multiplexer = None, mode = 'transmission', direction = 'forward', waves = None):
 
         # configure multiplexer, if applicable
         if multiplexer != None:
@@ -225,7 +310,11 @@ class Picoscope():
         cHandle = self.cHandle
         timebase = self.timebase
         samples = self.samples
-        numberOfWaves = self.params['waves']
+        maxWaves = self.params['waves']
+        if waves is None:
+            numberOfWaves = maxWaves
+        else:
+            numberOfWaves = min(waves, maxWaves)
 
         #Create a c type for numberOfSamples that can be passed to the ps2000a functions
         cNumberOfSamples = ctypes.c_int32(self.samples)
@@ -234,45 +323,28 @@ class Picoscope():
         #For 2 channel measurements, each channel needs an overflow flag so we allocate 2 * numberOfWaves
         overflow = (ctypes.c_int16 * numberOfWaves )()
 
-        #Divide picoscope memory into segments for rapidblock capture(Important)
-        memorySegments = ps.ps2000aMemorySegments(self.cHandle, numberOfWaves, ctypes.byref(cNumberOfSamples))
-        assert_pico_ok(memorySegments)
-
-        #Set the number of captures (=wavesToCollect) on the picoscope
-        self.setCaptures = ps.ps2000aSetNoOfCaptures(self.cHandle, numberOfWaves)
-
-        #Error check set captures
-        if self.setCaptures == "PICO_OK":
-            pass
-        else:
-            # print("Error: Problem setting number of captures on picoscope: " + self.setCaptures)
-            assert_pico_ok(self.setCaptures)
-
-        #Set up memory buffers to receive data from channel B
-        bufferArrayChannelB = np.empty((numberOfWaves, self.samples), dtype = ctypes.c_int16)
-        #Convert bufferArrayChannelB to a ctype
-        bufferArrayChannelBCtype = np.ctypeslib.as_ctypes(bufferArrayChannelB)
-
-        #Set up memory buffers for channel A.
-        bufferArrayChannelA = np.empty((numberOfWaves, self.samples), dtype = ctypes.c_int16)
-        bufferArrayChannelACtype = np.ctypeslib.as_ctypes(bufferArrayChannelA)
+        # segments and data buffers stay registered on the scope between captures, so they only need to be
+        #   sent when the number of waves or samples has changed since the last measurement
+        # segments are always set up for the full number of waves so shorter captures can reuse them
+        captureKey = (maxWaves, self.samples)
+        if captureKey != self.lastCaptureKey:
+            self.setupCaptureBuffers(maxWaves, cNumberOfSamples)
+            self.lastCaptureKey = captureKey
+
+        #Set the number of captures (=wavesToCollect) on the picoscope, if it has changed
+        if numberOfWaves != self.numberOfCaptures:
+            self.setCaptures = ps.ps2000aSetNoOfCaptures(self.cHandle, numberOfWaves)
+
+            #Error check set captures
+            if self.setCaptures == "PICO_OK":
+                pass
+            else:
+                # print("Error: Problem setting number of captures on picoscope: " + self.setCaptures)
+                assert_pico_ok(self.setCaptures)
+            self.numberOfCaptures = numberOfWaves
 
-        # bufferArrayChannelBPointer = bufferArrayChannelB.ctypes.data_as(c_int16_pointer)
-        for wave in range(numberOfWaves):
-            # bufferArrayChannelB[wave] = (ctypes.c_int16 * numberOfSamples)()
-            # dataPointer = bufferArrayChannelB[wave].ctypes.data_as(c_int16_pointer)
-            # Setting the data buffer location for data collection from channel B
-            # handle = chandle
-            # source = ps2000a_channel_B = 1
-            # Buffer location = ctypes.byref(bufferArrayChannelB[wave])
-            # Buffer length = numberOfSampless
-            # Segment index = wave
-            # Ratio mode = ps2000a_Ratio_Mode_None = 0 (we are not downsampling)
-            waveC = ctypes.c_uint32(wave)
-            dataBufferB = ps.ps2000aSetDataBuffer(self.cHandle, 1, ctypes.byref(bufferArrayChannelBCtype[wave]), self.samples, waveC, 0)
-            assert_pico_ok(dataBufferB)
-            dataBufferA = ps.ps2000aSetDataBuffer(self.cHandle, 0, ctypes.byref(bufferArrayChannelACtype[wave]), self.samples, waveC, 0)
-            assert_pico_ok(dataBufferA)
+        # only the first numberOfWaves segments are filled by this capture
+        bufferArrayChannelA = self.bufferArrayChannelA[:numberOfWaves]
 
         # Start block capture
         # handle = cHandle
@@ -314,9 +386,11 @@ class Picoscope():
 
         # # Convert waveform values from ADC to mV
         # # First find the maxADC value
-        maxADC = ctypes.c_int16()
-        self.maximumValue = ps.ps2000aMaximumValue(self.cHandle, ctypes.byref(maxADC))
-        assert_pico_ok(self.maximumValue)
+        if self.maxADC is None:
+            self.maxADC = ctypes.c_int16()
+            self.maximumValue = ps.ps2000aMaximumValue(self.cHandle, ctypes.byref(self.maxADC))
+            assert_pico_ok(self.maximumValue)
+        maxADC = self.maxADC
 
         # Then convert the mean data array from ADC to mV using the sdk function
         buffermVA = np.array(adc2mV(bufferMeanA, self.voltageIndex, maxADC))
@@ -328,11 +402,6 @@ class Picoscope():
         stopTime = startTime + (timeInterval * (self.samples - 1))
         waveTime = np.linspace(startTime, stopTime, self.samples)
 
-        #Might need to free up memory for longer scans by deleting the buffer arrays
-        # this is probably handled by python garbage collection and is unnecessary
-        del bufferArrayChannelB
-        del bufferArrayChannelA
-
         # return data all data
         return buffermVA, waveTime
 
@@ -585,7 +654,7 @@ class Picoscope():
         voltage, time = self.optimizeOffset(multiplexer,  direction, baselineTolerance, baselinePoints)
 
         # determine whether to run optimizeGain i.e. the offset wave is outside of [minV, maxV]
-        voltageMax = np.max(abs(voltage))
+        voltageMax = self.absoluteMaximum(voltage)
         if voltageMax < minV or voltageMax > maxV:
             voltageG, timeG = self.optimizeGain(multiplexer, direction, minV, maxV)
 
@@ -668,7 +737,7 @@ class Picoscope():
         # adjust offset as well for next measurement
         self.calculateVoltageOffset(direction, voltage)
 
-        absMax = np.max(abs(voltage))
+        absMax = self.absoluteMaximum(voltage)
 
         # base case 1: minV <= absMax <= maxV -> success! return values
         if absMax <= maxV and absMax >= minV:
@@ -723,70 +792,72 @@ class Picoscope():
             return math.ceil(newGain)
 
 
-    # Recursively determines the minimum voltage range needed to capture data at the current location
+    # Determines the minimum voltage range needed to capture data at the current location
     # Returns the waveform data at the proper range
     # Inputs a multiplexer object and direction. If no multiplexer is used, default to None
     # This should only add extra time if the voltage range has changed from the previous pixel
+    # If the waveform is cut off its true maximum is unknown, so the range is stepped up one limit at a time until it fits
+    #   Once it fits, the tightest range is found directly from the measured maximum so at most one extra measurement is needed
+    # The search only needs the peak voltage, so the measurements while stepping up use rangeFinderPreviewWaves waves.
+    #   A full measurement is only taken again once the final range is known
     # NOTE: this is only defined for transmission measurements. mode is implicitly 'transmission' when this is called
     def voltageRangeFinder(self, multiplexer = None, direction = 'forward'):
 
-        # hardcoded voltage limits
-        voltageLimits = np.array([0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20])
-
-        # hardcoded tolerance limit - change limit if max is within 5%
-        tolerance = 0.95
-        voltageTolerances = tolerance * voltageLimits
+        # hardcoded voltage limits and tolerances, defined at the top of the module
+        # comparisons are done in mV since that is what runRapidBlock returns
+        voltageLimits = picoVoltageLimits
+        voltageTolerances = picoVoltageTolerancesmV
+        maxIndex = len(voltageLimits) - 1
 
-        currentLimit = self.params['voltageRange']
-        currentTolerance = tolerance * currentLimit
+        # index of the current limit. The scope uses the first limit >= voltageRange (see voltageIndexFromRange)
+        rangeIndex = min(np.searchsorted(voltageLimits, self.params['voltageRange'], side = 'left'), maxIndex)
 
-        # collect initial waveform and find max. Convert to mV
+        # collect initial waveform and find max, in mV
+        # this is a full measurement since the range usually does not change between pixels, so it is normally the one returned
         voltage, time = self.runRapidBlock(multiplexer, 'transmission', direction)
-        # needs to check vs the max and the min in case the negative portion exceeds the limit
-        maxV = max([abs(np.max(voltage)/1000), abs(np.min(voltage)/1000)])
+        maxV = self.absoluteMaximum(voltage)
+        fullMeasurement = True
 
-        # base case 1 : currentLimit == lowest limit and max < current limit. return waveform
-        if currentLimit == voltageLimits[0] and maxV < currentLimit:
+        # currentLimit == lowest limit and max < current limit. return waveform
+        if rangeIndex == 0 and maxV < picoVoltageLimitsmV[0]:
             return voltage, time
 
-        # base case 2 : currentLimit == highest limit and max > highest tolerance. return waveform and print a warning
-        elif currentLimit == voltageLimits[-1] and maxV >= currentTolerance:
+        # max > current tolerance, so the peak is cut off. Step up to the next highest voltage limit and take a preview
+        #   measurement until it fits
+        while maxV > voltageTolerances[rangeIndex] and rangeIndex < maxIndex:
+            rangeIndex += 1
+            self.params['voltageRange'] = voltageLimits[rangeIndex]
+            voltage, time = self.runRapidBlock(multiplexer, 'transmission', direction, waves = rangeFinderPreviewWaves)
+            maxV = self.absoluteMaximum(voltage)
+            fullMeasurement = False
+
+        # currentLimit == highest limit and max > highest tolerance. return waveform and print a warning
+        if maxV > voltageTolerances[rangeIndex]:
             print(
                 "Warning: voltageRangeFinder- waveform voltage exceeds oscilloscope maximum. Peaks are likely to be cutoff.")
-            return voltage, time
-
-        # base case 3 : max < current limit. set voltage range to be lowest range within tolerance, rerun measurement and return waveform
-        elif maxV <= currentTolerance:
-
-            # return index of first (lowest) tolerance that is >= maxV
-            # taking [0][0] of the result is safe since maxV < currentTolerance implies the condition is met at least once
-            rangeIndex = np.nonzero(voltageTolerances >= maxV)[0][0]
-            limit = voltageLimits[rangeIndex]
-
-            # if that tolerance is the current tolerance, return waveform, params
-            if limit == currentLimit:
+            if fullMeasurement:
                 return voltage, time
+            return self.runRapidBlock(multiplexer, 'transmission', direction)
 
-            # if not, setup a new measurement with the tighter voltage limit and return that data
-            else:
-                self.params['voltageRange'] = limit
-                return self.runRapidBlock(multiplexer, 'transmission', direction)
+        # the waveform fits. find the index of first (lowest) tolerance that is >= maxV
+        # this is always <= rangeIndex since maxV <= voltageTolerances[rangeIndex]
+        limitIndex = np.searchsorted(voltageTolerances, maxV, side = 'left')
 
-        # recursion case : max > current tolerance. try again at the next highest voltage limit
-        else:
+        # if that is the current limit and the waveform is a full measurement, return waveform
+        if limitIndex == rangeIndex and fullMeasurement:
+            return voltage, time
 
-            # get the index of the current limit
-            rangeIndex = np.nonzero(voltageLimits == currentLimit)[0][0]
+        # if not, setup a new measurement with the tightest voltage limit and return that data
+        self.params['voltageRange'] = voltageLimits[limitIndex]
+        return self.runRapidBlock(multiplexer, 'transmission', direction)
 
-            # just for safety, check that range index is not the last index. this shouldn't be possible, but just in case I'm missing an edge case
-            if rangeIndex == len(voltageLimits) - 1:
-                return voltage, time
+    # helper function that returns the largest absolute value in a voltage array
+    # checks the max and the min in case the negative portion is larger. This avoids allocating a temporary array
+    #   for abs(voltage) since it only needs two passes over the data
+    @staticmethod
+    def absoluteMaximum(voltage):
+        return max(float(np.max(voltage)), -float(np.min(voltage)))
 
-            # move to the next higher voltage limit and try again
-            else:
-                self.params['voltageRange'] = voltageLimits[rangeIndex + 1]
-                return self.voltageRangeFinder(multiplexer, direction)
-            
     # helper function that finds the maximum voltage from transmission data
     # inputs the dict returned from running runPicoMeasurement()
     # returns the max value in mV
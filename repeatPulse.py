@@ -36,15 +36,8 @@ def repeatPulse(params):
     #                                            params['voltageRange'],
     #                                            params['samples'],
     #                                            params['measureTime'])
-    # Adjust pulser pulsewidth
-    pulser.setFrequency(params['transducerFrequency'])
-
-    # Set the number of half cycles if using tone burst pulser
-    if pulser.type == 'tone burst':
-        pulser.setHalfCycles(params['halfCycles'])
-
-    # Turn on the pulser
-    pulser.pulserOn()
+    # Adjust pulser pulsewidth, set the number of half cycles if using tone burst pulser, and turn on the pulser
+    pulser.applySetup(params['transducerFrequency'], params['halfCycles'])
 
     # initialize time
     experimentTime = params['experimentTime']
@@ -110,4 +103,4 @@ def repeatPulse(params):
     if params['multiplexer']:
         multiplexer.closeMux()
     if params['saveFormat'] == 'sqlite':
-        database.connection.close()
\ No newline at end of file
+        database.close()
\ No newline at end of file
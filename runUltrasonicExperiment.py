@@ -1,8 +1,7 @@
-import ultrasonicScan as scan
-import multiscan
-import scanSetupFunctions as setup
-import repeatPulse
-import gui
+import importlib
+
+# NOTE: experiment modules are imported inside runExperiment so that only the modules needed for the chosen experiment
+#   are loaded. This keeps quick actions like 'move' from loading the picoscope SDK, matplotlib, and Qt
 
 ###################################################################
 #################  Operating Instructions  ########################
@@ -28,6 +27,7 @@ experimentParams = {
     #Once you have selected, fill out the values in the parameter list in the correct section
     #NOTE: ONLY CHANGE THE VALUES AFTER THE COLON ON EACH LINE
     'experiment' : 'single pulse',
+    'dryRun' : False,                                # Set to True to only check the parameters below for errors without connecting to any instruments
 
     #####################################################################
     ################# 'move' parameters #################################
@@ -58,6 +58,7 @@ experimentParams = {
     'waves' : 1000,                                  # Number of waves to collect and average
     'samples': 1000,                                  # Number of data points per wave
     'halfCycles' : 16,                               # Tone burst pulser only. Number of half-cycles in a tone burst pulse. Minimum 1, maximum 32
+    'singlePulsePlotFile' : None,                    # Single pulse only. File to save the waveform plot to (i.e. 'pulse.png'). None shows the plot in a window instead
 
     ##############################################################################################
     ######################## Advanced Options ####################################################
@@ -160,40 +161,79 @@ experimentParams = {
 ##########################################################################################
 
 
+# Maps each experiment to the (module, function) that runs it
+# 'move' = move the transducers
+# 'single pulse' = perform a single test pulse
+# 'repeat pulse' = repeat a pulse at a single location for a given time and frequency
+# 'single scan' = perform a single 2D scan
+# 'multi scan' = repeat a 2D scan with a set frequency
+experimentFunctions = {
+    'move' : ('scanSetupFunctions', 'moveScanner'),
+    'single pulse' : ('scanSetupFunctions', 'singlePulseMeasure'),
+    'repeat pulse' : ('repeatPulse', 'repeatPulse'),
+    'single scan' : ('ultrasonicScan', 'runScan'),
+    'multi scan' : ('multiscan', 'multiscan')
+}
+
+# Allowed values used to check the parameters before any instruments are connected
+validExperiments = tuple(experimentFunctions.keys())
+validVoltageRanges = (0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20)
+validAxes = ('X', 'Y', 'Z')
+
+# Checks the parameters for common typos before any modules or instruments are loaded
+# Raises a ValueError describing the first invalid parameter found
+def validateParams(params : dict):
+
+    experiment = params['experiment']
+    if experiment not in validExperiments:
+        raise ValueError("No experiment matches input '" + str(experiment) + "'. Valid experiments are: " + ", ".join(validExperiments))
+
+    # move only needs a valid axis
+    if experiment == 'move':
+        if str(params['axis']).upper() not in validAxes:
+            raise ValueError("'axis' must be 'X', 'Y', or 'Z'. Input was '" + str(params['axis']) + "'")
+        return
+
+    if params['voltageRange'] not in validVoltageRanges:
+        raise ValueError("'voltageRange' must be one of " + str(validVoltageRanges) + ". Input was " + str(params['voltageRange']))
+
+    if params['pulserType'] == 'tone burst' and params['halfCycles'] not in range(1, 33):
+        raise ValueError("'halfCycles' must be an integer between 1 and 32. Input was " + str(params['halfCycles']))
+
+    if experiment == 'single pulse':
+        return
+
+    if str(params['saveFormat']).lower() not in ('sqlite', 'json'):
+        raise ValueError("'saveFormat' must be 'sqlite' or 'json'. Input was '" + str(params['saveFormat']) + "'")
+
+    if experiment == 'single scan' or experiment == 'multi scan':
+        for axisKey in ('primaryAxis', 'secondaryAxis'):
+            if str(params[axisKey]).upper() not in validAxes:
+                raise ValueError("'" + axisKey + "' must be 'X', 'Y', or 'Z'. Input was '" + str(params[axisKey]) + "'")
+
 # Function to choose experiment function based on parameters
 def runExperiment(params : dict):
 
     if params['gui']:
+        import gui
         gui.startGUI(params)
 
     else:
-        # get the experiment from the input
-        experiment = params['experiment']
-
-        #run the appropriate experiment function
-        # 'move' = move the transducers
-        # 'single pulse' = perform a single test pulse
-        # 'single scan' = perform a single 2D scan
-        # 'multi scan' = repeat a 2D scan with a set frequency
-        match experiment:
-            case 'move':
-                setup.moveScanner(params)
+        # check the parameters before loading any instrument code
+        validateParams(params)
 
-            case 'single pulse':
-                setup.singlePulseMeasure(params)
+        # stop here if only checking the parameters
+        if params.get('dryRun'):
+            print("Config OK")
+            return
 
-            case 'repeat pulse':
-                repeatPulse.repeatPulse(params)
-
-            case 'single scan':
-                scan.runScan(params)
-
-            case 'multi scan':
-                multiscan.multiscan(params)
+        # get the experiment from the input
+        experiment = params['experiment']
 
-            #Match case where no matching expiment is input
-            case _:
-                print("No experiment matches input. Check the value of the 'experiment' parameter and ensure it is a valid experiment")
-                print("Valid experiments are: 'move', 'single pulse', 'single scan', and 'multi scan'")
+        # import the module for the experiment (validateParams has already checked that the experiment exists)
+        # and run the appropriate experiment function
+        moduleName, functionName = experimentFunctions[experiment]
+        experimentFunction = getattr(importlib.import_module(moduleName), functionName)
+        experimentFunction(params)
 
 runExperiment(experimentParams)
\ No newline at end of file
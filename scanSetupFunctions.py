@@ -3,15 +3,23 @@
 #   singlePulseMeasure - turns on pulser, takes a measurement with the picoscope at given parameters, outputs a plot
 #   repositionEnder - connects to Ender, moves, and disconnects so that it can be positioned at the starting point of a scan
 # This interface should be improved to better match setup protocols
+# NOTE: matplotlib is only imported by the functions that plot so that moves and scans do not pay for loading it
+import os
+import sys
+import numpy as np
 import ultratekPulser as utp
 import scanner as sc
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
-import time
 import picoscope as picoscope
 import mux
 
+# matplotlib backend used for plots made outside of the GUI. It is chosen once, before pyplot is first imported
+# Set the MPLBACKEND environment variable to use a different backend
+# TODO: TkAgg is used for compatibility with the linux computer, but Qt5 SHOULD work there too...
+plotBackend = os.environ.get('MPLBACKEND', 'TkAgg')
+
+# backend used when a plot is only saved to a file. Agg does not need a display and skips setting up any windows
+plotFileBackend = 'Agg'
+
 
 # Function to test collection parameters
 # Inputs: instrument ports dict and parameter dict defined at top of script
@@ -19,11 +27,6 @@ import mux
 # Outline: connects to pulser, picoscope, turns on pulser, sets up picoscope measurement, collects data, closes connections, plots data
 def singlePulseMeasure(params):
 
-    # if not using GUI, set matplotlib backend to 'Tk'
-    # TODO: this is done for compatibility with the linux computer, but Qt5 SHOULD work there too...
-    if params['gui'] == False:
-        matplotlib.use('TkAgg')
-
     # connect to multiplexer, if applicable
     if params['multiplexer']:
         multiplexer = mux.Mux(params)
@@ -36,15 +39,8 @@ def singlePulseMeasure(params):
     # Connect to picoscope & Set up pico measurement
     pico = picoscope.Picoscope(params, pulser)
 
-    # Adjust pulser pulsewidth
-    pulser.setFrequency(params['transducerFrequency'])
-
-    # Set the number of half cycles if using tone burst pulser
-    if pulser.type == 'tone burst':
-        pulser.setHalfCycles(params['halfCycles'])
-
-    # Turn on the pulser
-    pulser.pulserOn()
+    # Adjust pulser pulsewidth, set the number of half cycles if using tone burst pulser, and turn on the pulser
+    pulser.applySetup(params['transducerFrequency'], params['halfCycles'])
 
     waveDict = pico.runPicoMeasurement(multiplexer)
 
@@ -60,101 +56,49 @@ def singlePulseMeasure(params):
     if params['gui']:
         return waveDict
     else:
-        plotWaveDict(waveDict)
+        plotWaveDict(waveDict, params['singlePulsePlotFile'])
 
 # helper function to plot the waveDict returned by runPicoMeasurement()
 # handles arbitrary number of y-value keys, assumed x-axis is 'time'
-def plotWaveDict(waveDict):
+# if plotFile is given the plot is saved there instead of being shown in a window
+def plotWaveDict(waveDict, plotFile = None):
+
+    # set the backend the first time pyplot is imported. After that it is already set, so switching is skipped
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        if plotFile is None:
+            matplotlib.use(plotBackend)
+        else:
+            matplotlib.use(plotFileBackend)
+    import matplotlib.pyplot as plt
 
     time = waveDict['time']
+    # this isn't the best way to only select voltage keys but it works for now
+    voltageKeys = [key for key in waveDict.keys() if 'voltage' in key and 'Offset' not in key]
+
+    # all the voltages share the same time axis, so they are stacked as columns and plotted in a single call
     fig, ax = plt.subplots()
-    for voltageKey in waveDict.keys():
-        # this isn't the best way to only select voltage keys but it works for now
-        if 'voltage' in voltageKey and 'Offset' not in voltageKey:
-            ax.plot(time, waveDict[voltageKey], label = voltageKey)
+    lines = ax.plot(time, np.column_stack([waveDict[key] for key in voltageKeys]))
 
     plt.xlabel('Time (us)')
     plt.ylabel('Voltage (mV)')
-    plt.legend()
-    plt.show()
+    ax.legend(lines, voltageKeys)
+
+    if plotFile is None:
+        plt.show()
+    else:
+        fig.savefig(plotFile)
+        plt.close(fig)
 
 # Helper function to connect to and move the scanner
 # Inputs the parameters dict, which must contain the scannerPort, axis, and distance keys
-def moveScanner(params):
+# Optionally inputs an already open Scanner object, which is used instead of opening and closing a new connection
+def moveScanner(params, scanner = None):
+
+    if scanner is not None:
+        return scanner.move(params['axis'], params['distance'])
 
     scanner = sc.Scanner(params)
     moveRes = scanner.move(params['axis'], params['distance'])
     scanner.close()
     return moveRes
-
-# Recursively determines the minimum voltage range needed to capture data at the current location
-# Returns the waveform data at the proper rang and the updated params dict
-# This should only add extra time if the voltage range has changed from the previous pixel
-# def voltageRangeFinder(params):
-#
-#     # hardcoded voltage limits
-#     voltageLimits = np.array([0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20])
-#
-#     # hardcoded tolerance limit - change limit if max is within 5%
-#     tolerance = 0.95
-#     voltageTolerances = tolerance * voltageLimits
-#
-#     currentLimit = params['voltageRange']
-#     currentTolerance = tolerance * currentLimit
-#
-#     # collect initial waveform
-#     waveform = pico.runPicoMeasurement(params['waves'])
-#
-#     # find max of the waveform, divide by 1000 to convert to V
-#     maxV = np.max(abs(waveform[0]))/1000
-#
-#     # base case 1 : currentLimit == lowest limit and max < current limit. return waveform
-#     if currentLimit == voltageLimits[0] and maxV < currentLimit:
-#         return waveform, params
-#
-#     # base case 2 : currentLimit == highest limit and max > highest tolerance. return waveform and print a warning
-#     elif currentLimit == voltageLimits[-1] and maxV >= currentTolerance:
-#         print("Warning: voltageRangeFinder- waveform voltage exceeds oscilloscope maximum. Peaks are likely to be cutoff.")
-#         return waveform, params
-#
-#     # base case 3 : max < current limit. set voltage range to be lowest range within tolerance, rerun measurement and return waveform, params
-#     elif maxV <= currentTolerance:
-#
-#         # return index of first (lowest) tolerance that is >= maxV
-#         # taking [0][0] of the result is safe since maxV < currentTolerance implies the condition is met at least once
-#         rangeIndex = np.nonzero(voltageTolerances >= maxV)[0][0]
-#         limit = voltageLimits[rangeIndex]
-#
-#         # if that tolerance is the current tolerance, return waveform, params
-#         if limit == currentLimit:
-#             return waveform, params
-#
-#         # if not, setup a new measurement with the tighter voltage limit and return that data
-#         else:
-#             params['voltageRange'] = limit
-#             picoConnection = pico.setupPicoMeasurement(
-#                                                params['measureDelay'],
-#                                                params['voltageRange'],
-#                                                params['samples'],
-#                                                params['measureTime'])
-#             waveform = pico.runPicoMeasurement(params['waves'])
-#             return waveform, params
-#
-#     # recursion case : max > current tolerance. try again at the next highest voltage limit
-#     else:
-#
-#         # get the index of the current limit
-#         rangeIndex = np.nonzero(voltageLimits == currentLimit)[0][0]
-#
-#         # just for safety, check that range index is not the last index. this shouldn't be possible, but just in case I'm missing a case
-#         if rangeIndex == len(voltageLimits) - 1:
-#             return waveform, params
-#
-#         # move to the next higher voltage limit and try again
-#         else:
-#             params['voltageRange'] = voltageLimits[rangeIndex + 1]
-#             picoConnection = pico.setupPicoMeasurement(params['measureDelay'],
-#                                                        params['voltageRange'],
-#                                                        params['samples'],
-#                                                        params['measureTime'])
-#             return voltageRangeFinder(params)
\ No newline at end of file
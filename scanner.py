@@ -5,45 +5,114 @@
 # Variables:
 #   port - USB port address of scanner
 #   serial - Pyserial Serial object for the connection to the scanner
-#   minDimensions - 3-tuple of the minimum coordinates the scanner can safely move to. Equal to (0, 0, transducer holder height)
-#   maxDimensions - 3-tuple of the max coordinates the scanner can move to. Determined by the printer volume. For Ender-3 it is (220, 220, 240)
+#   minDimensions - len-3 numpy array of the minimum coordinates the scanner can safely move to. Equal to (0, 0, transducer holder height)
+#   maxDimensions - len-3 numpy array of the max coordinates the scanner can move to. Determined by the printer volume. For Ender-3 it is (220, 220, 240)
+#   position - numpy array of the tracked (x, y, z) position, updated by each move. None until it is first read from the scanner
 # Functions:
 #   init(parameters : dict) - initializes the connection to the scanner and other variables based on information passed in parameters dict
 #                             parameters must include 'scannerPort', 'transducerHolderHeight', and 'scannerMaxDimensions'
+#   enableLowLatency() - turns off the read delay of USB serial adapters on Linux so replies from the scanner arrive sooner
 #   write(command : str) - formats arbitrary strings and passes them through the serial connection
+#   writeBytes(formattedCommands : bytes) - passes commands already encoded by formatCommands through the serial connection
 #   move(axis : str, distance : number) - moves along the specified axis and distance
-#   currentPosition() - gets the current position from the scanner. Returns a 3-tuple of the (x, y, z) coordinates
-#   safeMoveQ(axis : str, distance : number) - checks that a proposed move is within min/maxDimensions of scanner. Returns a Boolean
+#   waitForMoves() - blocks until the scanner has finished all of its moves. Raises serial.SerialTimeoutException if they
+#                    have not finished long after they should have (see slowestMoveSpeed)
+#   readAck() - reads until the scanner replies 'ok' to a command. Raises serial.SerialTimeoutException if there is no reply
+#   readPendingAcks() - reads the replies to the last move, which move() leaves for the next command to read
+#   currentPosition() - gets the current position from the scanner and updates the tracked position. Returns a 3-tuple of the (x, y, z) coordinates
+#   resyncPosition() - reads the current position from the scanner and stores it as the tracked position
+#   safeMoveQ(axis : str, distance : number, currentPos = None) - checks that a proposed move is within min/maxDimensions of scanner. Returns a Boolean
+#                             currentPos is an optional (x, y, z) position to move from instead of the tracked position
+#   safeDisplacementQ(movePos : array) - same as safeMoveQ for a move given as a len-3 displacement array
 #   home() - runs the scanner homing protocol to calibrate its current position by moving to (0,0,0)
 #            NOTE: DO NOT RUN THIS WITH THE TRANSDUCER HOLDER OR ANY EXPERIMENTAL MATERIALS ON THE SCANNER STAGE
 #   cancel() - stops the current move action. Cannot cancel a home() command
 #   close() - stops the current serial connection
-# Also includes two helper functions
+# Also includes three helper functions
 #   axisDistanceToArray(axis : str, distance : number) - converts an axis/distance pair into a len-3 numpy array corresponding to the move
 #   validAxisQ(axis : str) - tests whether an input string is a valid axis
+#   formatCommands(commands : list) - encodes a list of GCode strings into one bytes object that can be sent in a single write
 
+import re
+import time
 import serial
 import numpy as np
 
+# termios is only available on Linux/Mac. It is used to stop the scanner from resetting when the port is closed
+try:
+    import termios
+except ImportError:
+    termios = None
+
+# index of each axis in the (x, y, z) position arrays
+axisIndices = {'X' : 0, 'Y' : 1, 'Z' : 2}
+
+# unit vector along each axis, scaled by the distance to get a displacement array
+axisUnitVectors = {axis : np.eye(3)[index] for axis, index in axisIndices.items()}
+
+# pattern for the position in the reply to M114, i.e. b'X:100.00 Y:0.00 Z:160.00 E:0.00 Count X:8000 Y:0 Z:64000'
+# compiled once and matched directly against the bytes read from the scanner
+positionPattern = re.compile(rb'X:(-?\d+(?:\.\d+)?)\s+Y:(-?\d+(?:\.\d+)?)\s+Z:(-?\d+(?:\.\d+)?)')
+
+# commands sent before the first move, and again before the next move after currentPosition() switches to absolute positioning
+#   G21 - set ender units to millimeters
+#   G91 - set positioning to relative (not absolute)
+#   M121 - disable endstops
+#TODO: figure out why disabling endstops is necessary, update for safety
+relativeModeCommands = ["G21", "G91", "M121"]
+
+# commands sent together by currentPosition()
+#   G90 - set positioning to absolute
+#   M114 - report the current position
+positionCommands = ["G90", "M114"]
+
+# slowest speed (in mm/s) a queued move is expected to run at. waitForMoves gives up if the moves sent since the last wait
+#   have not finished after the read timeout plus the time to travel their total distance at this speed
+slowestMoveSpeed = 1
+
 # Scanner class controls the 3D motion of the gantry via pyserial. Tested on Ender-3 3D printer gantry, but should work
 # with any gantry that operates on GCode
 class Scanner():
 
     # establish connection via Serial object
     # the parameterDict must contain the keys 'scannerPort', 'transducerHolderHeight' and 'scannerMaxDimensions'
-    def __init__(self, parameters : dict, baudRate = 115200):
+    # timeout is the time in seconds to wait for a reply from the scanner before raising an error
+    def __init__(self, parameters : dict, baudRate = 115200, timeout = 10):
 
         if 'scannerPort' not in parameters.keys() or 'transducerHolderHeight' not in parameters.keys() or 'scannerMaxDimensions' not in parameters.keys():
             raise KeyError("Scanner: input parameters does not contain enough information. "
                   "parameters must be a dict with keys \'scannerPort\', \'transducerHolderHeight\' and \'scannerMaxDimensions\'")
 
         self.port = parameters['scannerPort']
-        self.minDimensions = (0, 0, parameters['transducerHolderHeight'])
-        self.maxDimensions = parameters['scannerMaxDimensions']
+        # stored as numpy arrays so safeDisplacementQ can compare all 3 axes at once
+        self.minDimensions = np.array((0, 0, parameters['transducerHolderHeight']), dtype = float)
+        self.maxDimensions = np.array(parameters['scannerMaxDimensions'], dtype = float)
+
+        # (encoded G1 command, displacement array) for moves that have already been made, keyed by (axis, distance)
+        # a scan only uses a handful of different moves, so each one is only formatted once
+        self.moveCommands = {}
+
+        # whether the scanner has been set to mm units, relative positioning, and disabled endstops (see move)
+        # these settings stay on the scanner until changed, so they are only sent again after currentPosition() switches to absolute
+        self.relativeMode = False
+        self.relativeModeBytes = self.formatCommands(relativeModeCommands)
+        self.positionBytes = self.formatCommands(positionCommands)
+
+        # position of the scanner as a numpy array of (x, y, z). It is read from the scanner by the first safeMoveQ() (or any
+        #   currentPosition() call) and then updated by each move, so checking a move does not need a round trip to the scanner
+        # None means the position is unknown and has to be read again (see resyncPosition)
+        self.position = None
+
+        # number of replies to the last move that have not been read yet (see move)
+        self.pendingAcks = 0
+
+        # total distance in mm of the moves sent since the last waitForMoves(), used to limit how long it waits
+        self.queuedDistance = 0
 
         try:
             # Open serial port
-            self.serial = serial.Serial(parameters['scannerPort'], baudRate)
+            # with a timeout, reads return whatever has been received once it runs out instead of blocking forever
+            self.serial = serial.Serial(parameters['scannerPort'], baudRate, timeout = timeout)
 
         # catch errors in connection
         except serial.SerialException as error:
@@ -51,101 +120,234 @@ class Scanner():
 
             raise serial.SerialException
 
+        self.disableHangupOnClose()
+        self.enableLowLatency()
+
+    # Arduino based boards like the Ender-3 reset whenever the DTR line drops, which happens by default when the port is closed
+    #   so the next connection has to wait for the board to reboot. Clearing the HUPCL flag on the port keeps DTR up after close
+    #   so moves that reopen the port (i.e. from the GUI) do not reset the scanner
+    # Only applies on Linux/Mac. Does nothing on Windows
+    def disableHangupOnClose(self):
+
+        if termios is None:
+            return
+
+        try:
+            attributes = termios.tcgetattr(self.serial.fileno())
+            # index 2 is the control flags
+            attributes[2] &= ~termios.HUPCL
+            termios.tcsetattr(self.serial.fileno(), termios.TCSANOW, attributes)
+        except (termios.error, OSError, ValueError) as error:
+            print(f"Scanner.disableHangupOnClose: unable to clear HUPCL, scanner may reset when the port is closed: {error}")
+
+    # USB serial adapters on Linux hold incoming data for up to 16 ms by default before passing it on, which delays every
+    #   reply read from the scanner. Low latency mode turns this off so replies are read as soon as they arrive
+    # Only available on Linux. Does nothing on other systems
+    def enableLowLatency(self):
+
+        if not hasattr(self.serial, 'set_low_latency_mode'):
+            return
+
+        try:
+            self.serial.set_low_latency_mode(True)
+        except (NotImplementedError, OSError, ValueError) as error:
+            print(f"Scanner.enableLowLatency: unable to set low latency mode, scanner replies may be slower: {error}")
+
     # encode strings to the proper format and send to the scanner via serial
     def write(self, command):
 
-        # commands need a space, carriage return, and newline to be accepted
-        formattedCommand = command + " \r\n"
+        self.writeBytes(self.formatCommands([command]))
+
+    # sends already encoded commands (see formatCommands) to the scanner via serial
+    def writeBytes(self, formattedCommands : bytes):
 
         try:
-            self.serial.write(formattedCommand.encode('utf-8'))
+            self.serial.write(formattedCommands)
 
         except serial.SerialException as error:
             print(f"Scanner.write: Error writing command to scanner: {error}")
             raise serial.SerialException
 
+    # encodes a list of commands into a single bytes object so they can be sent in one write
+    @staticmethod
+    def formatCommands(commands : list):
+
+        # commands need a space, carriage return, and newline to be accepted
+        return "".join([command + " \r\n" for command in commands]).encode('utf-8')
+
     # Writes a series of commands to perform relative movements with the scanner
     # Inputs the axis of motion as a string ('X','Y', or 'Z'), and the distance to move (in mm) (can be negative)
     #   Also an optional checkMoveSafety flag which should always be set to true unless debugging a scanner that has not been homed
     # function translates the movement to GCode and passes it to the scanner
     def move(self, axis : str, distance, checkMoveSafety = True):
 
-        if not self.validAxisQ(axis):
-            raise ValueError('Input axis is not \'X\', \'Y\', or \'Z\'')
-
-        if checkMoveSafety and not self.safeMoveQ(axis, distance):
+        # Convert axis and distance inputs into the proper G1 motion command and displacement array, reusing them if this
+        #   move has been made before
+        try:
+            moveCommand, movePos = self.moveCommands[(axis, distance)]
+        except KeyError:
+            # the axis only needs to be checked the first time a move is made (axisDistanceToArray raises a ValueError)
+            movePos = self.axisDistanceToArray(axis, distance)
+            moveCommand = self.formatCommands(["G1 " + axis.upper() + str(distance)])
+            self.moveCommands[(axis, distance)] = (moveCommand, movePos)
+
+        if checkMoveSafety and not self.safeDisplacementQ(movePos):
             print("Scanner.move Error: input move is not safe. Check that there is enough space for the scanner to make the desired move.")
             return -1
 
-        # make uppercase
-        upperAxis = axis.upper()
-
-        # Convert axis and distance inputs into the proper GCode
-        motionCommand = "G1 " + upperAxis + str(distance)
-
-        # Set ender units to millimeters
-        unitRes = self.write("G21")
+        # only one move is sent ahead of its replies, so the scanner's serial buffer cannot overflow
+        if checkMoveSafety:
+            self.readPendingAcks()
 
-        # Set positioning to relative (not absolute)
-        posRes = self.write("G91")
+        # if the scanner is not in relative mode, the motion command is sent in the same write as relativeModeCommands
+        if self.relativeMode:
+            self.writeBytes(moveCommand)
+            numberOfCommands = 1
+        else:
+            self.writeBytes(self.relativeModeBytes + moveCommand)
+            numberOfCommands = 1 + len(relativeModeCommands)
+            self.relativeMode = True
 
-        # Disable endstops
-        #TODO: figure out why this is necessary, update for safety
-        popRes = self.write("M121")
+        if self.position is not None:
+            self.position = self.position + movePos
 
-        # Send motion command
-        moveRes = self.write(motionCommand)
+        self.queuedDistance += abs(distance)
 
-        # flush out the responses. It is unclear why 5 reads are needed for 4 commands, but testing has shown it is needed
-        # this is only done when safeMoveQ is being called, otherwise the mover hangs
+        # there is one 'ok' response for each command. They are not waited for here, instead they are read before the next
+        #   command is sent (i.e. the M400 in waitForMoves), which saves a round trip to the scanner for every move
+        # this is only done when checkMoveSafety is set, since the test moves made with it off may be sent to a port that is not the scanner
         if checkMoveSafety:
-            for i in range(5):
-                self.serial.read_until()
+            self.pendingAcks = numberOfCommands
+
+    # Waits until the scanner has finished all of the moves it has been sent
+    # M400 makes the scanner finish its queued moves before it replies 'ok', so this returns as soon as motion stops
+    #   instead of waiting a fixed amount of time
+    def waitForMoves(self):
+
+        # M400 is sent before reading the replies to the last move so both arrive in one round trip
+        self.write("M400")
+        self.readPendingAcks()
+
+        # long moves can take longer than the read timeout, so timed out reads are retried until the queued moves should
+        #   have finished even at slowestMoveSpeed. After that the scanner is assumed to have stopped replying (i.e. it reset
+        #   or dropped the command)
+        deadline = time.monotonic() + (self.serial.timeout or 0) + self.queuedDistance / slowestMoveSpeed
+        self.queuedDistance = 0
+
+        # skip any other messages the scanner sends before the 'ok'
+        while True:
+            serialRead = self.serial.read_until()
+            if serialRead.startswith(b'ok'):
+                return
+            if not serialRead.endswith(b'\n'):
+                if time.monotonic() > deadline:
+                    print("Scanner.waitForMoves: timed out waiting for the scanner to finish its moves")
+                    raise serial.SerialTimeoutException
+                print("Scanner.waitForMoves: no reply from the scanner yet, still waiting for the moves to finish")
+
+    # reads the reply to a command, skipping any other messages the scanner sends before the 'ok'
+    # raises a SerialTimeoutException if the scanner does not reply within the read timeout
+    def readAck(self):
+
+        while True:
+            serialRead = self.serial.read_until()
+            if serialRead.startswith(b'ok'):
+                return
+            if not serialRead.endswith(b'\n'):
+                print("Scanner.readAck: timed out waiting for a reply from the scanner")
+                raise serial.SerialTimeoutException
+
+    # reads the replies to the last move that move() did not wait for
+    def readPendingAcks(self):
+
+        while self.pendingAcks > 0:
+            self.readAck()
+            self.pendingAcks -= 1
 
     def currentPosition(self):
 
-        # set to absolute positioning
-        self.write("G90")
-        self.serial.read_until()
-        # gather the current position from the scanner
-        self.write("M114")
-        serialRead = self.serial.read_until()
-        pos = serialRead.decode('utf-8')
+        self.readPendingAcks()
 
+        # set to absolute positioning and gather the current position from the scanner in a single write
+        # the scanner replies to the commands in order, so the 'ok' for G90 comes before the position
+        self.writeBytes(self.positionBytes)
+        self.readAck()
+        self.relativeMode = False
         # output string is 'X:100.00 Y:0.00 Z:160.00 E:0.00 Count X:8000 Y:0 Z:64000'
+        # the scanner can send other messages first (i.e. 'echo:busy: processing'), so lines are read until one contains the position
+        posMatch = None
+        while posMatch is None:
+            serialRead = self.serial.read_until()
+            if not serialRead.endswith(b'\n'):
+                print("Scanner.currentPosition: timed out waiting for the position from the scanner")
+                raise serial.SerialTimeoutException
+            posMatch = positionPattern.search(serialRead)
+        # M114 also replies with 'ok' after the position
+        self.readAck()
+
         # need to format to return (X,Y,Z)
-        splitPos = [coor.split(':') for coor in pos.split()]
-        x = float(splitPos[0][1])
-        y = float(splitPos[1][1])
-        z = float(splitPos[2][1])
+        x, y, z = map(float, posMatch.groups())
+
+        # any position read from the scanner also replaces the tracked position
+        self.position = np.array((x,y,z))
 
         return (x,y,z)
 
+    # reads the position from the scanner and replaces the tracked position with it
+    # use this to correct the tracked position if the scanner could have moved without Scanner.move() (i.e. by hand)
+    def resyncPosition(self):
+
+        self.currentPosition()
+
+        return self.position
+
     # test whether a given move is safe based on the measurements of the scanner and transducer holder
-    def safeMoveQ(self, axis, distance):
+    # uses the tracked position, so the scanner is only queried if the position is unknown
+    # currentPos can be given to check a move from another position (i.e. a later point of a planned scan) without querying the scanner
+    def safeMoveQ(self, axis, distance, currentPos = None):
 
-        if not self.validAxisQ(axis):
+        index = axisIndices.get(axis.upper())
+        if index is None:
             raise ValueError('Input axis is not \'X\', \'Y\', or \'Z\'')
 
+        if currentPos is None:
+            if self.position is None:
+                self.resyncPosition()
+            currentPos = self.position
+
+        # only the coordinate along axis changes, so it is the only one that needs to be checked
+        destination = currentPos[index] + distance
+
+        return bool(self.minDimensions[index] <= destination <= self.maxDimensions[index])
+
+    # test whether moving by movePos, a len-3 numpy array of the (x, y, z) displacement, is safe
+    def safeDisplacementQ(self, movePos):
+
+        if self.position is None:
+            self.resyncPosition()
+
         # get the current position, destination position
-        currentPos = np.array(self.currentPosition())
-        movePos = self.axisDistanceToArray(axis, distance)
+        currentPos = self.position
         destinationPos = currentPos + movePos
 
-        # iterate through destinationPos and check vs max and min dimensions
-        for i in range(3):
-            if destinationPos[i] < self.minDimensions[i] or destinationPos[i] > self.maxDimensions[i]:
-                return False
+        # check destinationPos vs max and min dimensions on all axes at once
+        if np.any(destinationPos < self.minDimensions) or np.any(destinationPos > self.maxDimensions):
+            return False
 
         return True
 
     # NOTE: DO NOT RUN WHILE THE TRANSDUCER HOLDER IS ATTACHED
     def home(self):
         self.write("G28")
+        self.position = None
+        # homing can travel across the whole scanner volume
+        self.queuedDistance += float(np.sum(self.maxDimensions))
 
     # NOTE: this will not cancel the home command, it can only cancel ongoing move commands
+    # the scanner stops partway through the move, so the tracked position is no longer known
     def cancel(self):
         self.write("G80")
+        self.position = None
 
     def close(self):
 
@@ -158,23 +360,17 @@ class Scanner():
 
     # helper function to convert an axis, distance pair to a numpy array
     # i.e. 'X', 3 to [3,0,0] or 'Z', -5 to [0,0,-5]
-    @classmethod
-    def axisDistanceToArray(self, axis : str, distance):
+    @staticmethod
+    def axisDistanceToArray(axis : str, distance):
 
-        if not self.validAxisQ(axis):
+        unitVector = axisUnitVectors.get(axis.upper())
+        if unitVector is None:
             raise ValueError('Input axis is not \'X\', \'Y\', or \'Z\'')
-        if axis.upper() == 'X':
-            return np.array([distance, 0, 0])
-        elif axis.upper() == 'Y':
-            return np.array([0,distance,0])
-        elif axis.upper() == 'Z':
-            return np.array([0,0,distance])
+
+        return unitVector * distance
 
     # helper function to check if a given input string is 'X', 'Y', or 'Z'
     @staticmethod
     def validAxisQ(axis : str):
 
-        if axis.upper() in ['X', 'Y', 'Z']:
-            return True
-        else:
-            return False
+        return axis.upper() in axisIndices
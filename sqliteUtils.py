@@ -1,29 +1,73 @@
 import sqlite3
 import numpy as np
-from scipy.signal import hilbert
+import scipy.fft
 from typing import Callable
 from tqdm import tqdm
 import bottleneck as bn
 import os
 import time
 import math
-import json
+import warnings
+import threading
+import queue
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import pyplot as plt
-from matplotlib import colormaps as cmp
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+import database
 from database import Database
 
+# numba is optional. When it is installed, the per-sample loops of some analysis functions are compiled to machine code
+#   instead of building temporary numpy arrays
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 #Roadmap:
 
 ###############################################################
 #### Basic DB manipulation ###################################
 ###############################################################
 
+# Connection class used by openDB. It stores the results of PRAGMA table_info for each table (see tableInfo), since the
+#   columns of a table rarely change during an analysis but are looked up by many functions, and the coordinate steps
+#   of each scan (see scanGridSteps)
+class AnalysisConnection(sqlite3.Connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tableInfoCache = {}
+        # coordinate steps of each scan table, see scanGridSteps
+        self.scanGridCache = {}
+
+# Connection settings applied by openDB after the ones shared with Database
+# Analysis and plotting read the whole file, often several times, so they use a 256 MB page cache and memory map the
+#   entire file (sqlite limits the map to its compiled maximum, 2 GB by default), which turns page reads into memory reads
+analysisPragmas = "PRAGMA cache_size = -262144; PRAGMA mmap_size = 30000000000;"
+
 # TODO: create cursors within functions rather than pass around a global cursor?
 # Open a connection to the database specified in filepath and initialize a cursor
 # Returns the database connection object and the initialized cursor
 def openDB(fileName):
 
-    connection = sqlite3.connect(fileName, detect_types=sqlite3.PARSE_DECLTYPES)
+    # check_same_thread is disabled since analysis results are written from a background thread (see applyFunctionToData)
+    # isolation_level = None turns off the implicit transactions of the sqlite3 module, so single statements are committed
+    #   immediately and the batch writes (fastUpdateCol, updateCols) open and commit their own transaction
+    connection = sqlite3.connect(fileName, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread = False, isolation_level = None, factory = AnalysisConnection)
+
+    # write-ahead logging with synchronous = NORMAL means the analysis writes only need one sync per transaction
+    # new databases are already created in WAL mode (see Database), this also switches older ones
+    # these settings stay on the connection, so they are only set here rather than before every write
+    # in-memory databases have no file to log to, so they keep their default journal
+    if fileName != ':memory:':
+        if connection.execute("PRAGMA journal_mode = WAL").fetchone()[0] != 'wal':
+            print("openDB: unable to enable write-ahead logging, writes will be slower.")
+    # the remaining settings (synchronous, temp_store, cache and mmap sizes) are the same as Database and are run in one call
+    #   followed by the larger cache and memory map used for analysis (see analysisPragmas)
+    connection.executescript(database.connectionPragmas + analysisPragmas)
 
     # register numpy adapters
     sqlite3.register_adapter(np.ndarray, Database.adaptArray)
@@ -31,6 +75,13 @@ def openDB(fileName):
 
     cursor = connection.cursor()
 
+    # older scans were saved without an index on their coordinates, which is added once here
+    # databases that are not scans, or that cannot be written to (i.e. read only files), are used without it
+    try:
+        indexCoordinates(cursor)
+    except sqlite3.OperationalError:
+        pass
+
     return connection, cursor
 
 # Inputs a cursor and a name for a table
@@ -38,10 +89,7 @@ def openDB(fileName):
 # Use to extract a list of parameters for a given experiment, or to check what axes were scanned along
 def columnNames(cursor, table : str):
 
-    # Generate PRAGMA table_info query
-    query = "PRAGMA table_info(" + table + ")"
-
-    res = cursor.execute(query).fetchall()
+    res = tableInfo(cursor, table)
 
     # The result will be a list of tuples. The name of the column is entry 1
     names = []
@@ -50,6 +98,30 @@ def columnNames(cursor, table : str):
 
     return names
 
+# Inputs a cursor and a name for a table
+# Outputs the result of PRAGMA table_info, a list of (cid, name, type, notnull, default, pk) tuples for each column
+# For connections from openDB the result is cached on the connection, so the query only runs once per table
+#   Functions that change the columns of a table must call clearTableInfo
+def tableInfo(cursor, table : str):
+
+    cache = getattr(cursor.connection, 'tableInfoCache', None)
+    if cache is not None and table in cache:
+        return cache[table]
+
+    info = cursor.execute("PRAGMA table_info(" + table + ")").fetchall()
+
+    if cache is not None:
+        cache[table] = info
+
+    return info
+
+# Removes the cached PRAGMA table_info result of a table after its columns are changed
+def clearTableInfo(cursor, table : str):
+
+    cache = getattr(cursor.connection, 'tableInfoCache', None)
+    if cache is not None:
+        cache.pop(table, None)
+
 # Inputs a cursor and table name
 # Outputs the number of rows in the table
 def numberOfRows(cursor, table: str):
@@ -81,8 +153,9 @@ def retrieveParameters(cursor, table = 'parameters'):
 
     return paramDict
 
-# A function that executes an UPDATE query at a single (row,col) in the DB but does not commit it
-#   Avoiding commits gives a large speed improvement when iterating over many rows
+# A function that executes an UPDATE query at a single (row,col) in the DB
+#   Connections from openDB commit every statement on its own, so when iterating over many rows execute "BEGIN" first and
+#   "COMMIT" at the end. Avoiding commits gives a large speed improvement
 # Inputs the cursor objects, the name of the column to update, the name of the table
 #     and the column and value to use as the row identifier (should be the PRIMARY KEY of the table)
 # Outputs nothing
@@ -91,12 +164,15 @@ def updateCol(cur, column : str, table : str, value, keyCol, keyVal):
     # Generate the UPDATE query
     updateQuery = "UPDATE " + table + " SET " + column + " = ? WHERE " + keyCol + " = ?"
 
-    # Execute and commit the result
+    # Execute the query
     cur.execute(updateQuery, (value, keyVal))
 
+# number of values above which fastUpdateCol writes through a temporary staging table instead of one UPDATE per value
+stagingThreshold = 10000
+
 # Faster function to update columns using a list of values and their corresponding PRIMARY KEY values
-# Works by setting some memory parameters that increase speed (at the risk of corruption)
-# Then it manually opens a transaction, executes the update query, and closes the transation
+# Works by manually opening a transaction, executing the update query, and closing the transation
+# The connection settings that speed up the write (WAL, temp_store = MEMORY) are set once by openDB
 # Should be a MASSIVE performance improvement
 def fastUpdateCol(cur, column : str, table : str, values, keyCol : str, keyValues):
 
@@ -104,21 +180,58 @@ def fastUpdateCol(cur, column : str, table : str, values, keyCol : str, keyValue
         print("Error (fastUpdateCol): values and keyValues lists must have equal length")
         return -1
 
-    # First we convert the values and keyValues into paired sequences
-    insertSeq = ((v, kv) for v, kv in zip(values, keyValues))
+    # Manually opening and closing the transaction gives a large speed increase
+    # IMMEDIATE takes the write lock when the transaction opens instead of at the first UPDATE
+    cur.execute("BEGIN IMMEDIATE")
 
-    # speed boost from using ram as temp memory and not waiting for write confirmation
-    cur.execute("PRAGMA synchronous = OFF")
-    cur.execute("PRAGMA temp_store = MEMORY")
-    cur.execute("PRAGMA journal_mode = MEMORY")
+    # a failed update is rolled back, so the connection is not left holding the write lock in an open transaction
+    try:
+        if len(values) >= stagingThreshold:
+            # Large updates are inserted into a temporary table, then applied to the table with a single UPDATE query
+            #   temp_store = MEMORY keeps the staging table out of the file and its journal
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS staging_values (key_value INTEGER PRIMARY KEY, value)")
+            cur.execute("DELETE FROM staging_values")
+            cur.executemany("INSERT INTO staging_values VALUES (?, ?)", zip(keyValues, values))
+
+            # UPDATE ... FROM was added in sqlite 3.33, older versions use a correlated subquery
+            if sqlite3.sqlite_version_info >= (3, 33, 0):
+                updateQuery = "UPDATE " + table + " SET " + column + " = staging_values.value FROM staging_values WHERE " + table + "." + keyCol + " = staging_values.key_value"
+            else:
+                updateQuery = ("UPDATE " + table + " SET " + column + " = (SELECT value FROM staging_values WHERE key_value = " + table + "." + keyCol + ")"
+                               + " WHERE " + keyCol + " IN (SELECT key_value FROM staging_values)")
+            cur.execute(updateQuery)
 
-    # Manually opening and closing the transaction gives a large speed increase
-    cur.execute("BEGIN TRANSACTION")
+            # clear the staging table so the values are not kept in memory until the next update
+            cur.execute("DELETE FROM staging_values")
 
-    updateQuery = "UPDATE " + table + " SET " + column + " = ? WHERE " + keyCol + " = ?"
-    cur.executemany(updateQuery, insertSeq)
+        else:
+            # First we convert the values and keyValues into paired sequences
+            insertSeq = ((v, kv) for v, kv in zip(values, keyValues))
+
+            cur.executemany(updateQueryString((column,), table, keyCol), insertSeq)
+
+        cur.execute("COMMIT")
+    except:
+        cur.execute("ROLLBACK")
+        raise
+
+# Generates the UPDATE query used by fastUpdateCol and updateCols
+# UPDATE table SET column0 = ? WHERE keyCol = ? for a single column
+# UPDATE table SET (column0,column1,...) = (?,?,...) WHERE keyCol = ? for multiple columns
+# The queries only depend on the columns and table, so they are built once and cached. columns must be a tuple
+@lru_cache(maxsize = 256)
+def updateQueryString(columns : tuple, table : str, keyCol : str):
+
+    if len(columns) == 1:
+        return "UPDATE " + table + " SET " + columns[0] + " = ? WHERE " + keyCol + " = ?"
+
+    # convert the columns into a properly formatted string
+    formattedColumns = "(" +  ", ".join(columns) + ")"
+
+    # generate a string (?,?,...?) that is as long as len(columns)
+    qMarks = "(" + ("?," * (len(columns)-1)) + "?)"
 
-    cur.execute("END TRANSACTION")
+    return "UPDATE " + table + " SET " + formattedColumns + " = " + qMarks + " WHERE " + keyCol + " = ?"
 
 # Adds multiple values to multiple columns within a row. Runs many UPDATE queries in an optimized manner
 # columns is a list of column names as string. values is a list of tuples. The final member of each tuple must be the key value, the others are the column values
@@ -126,35 +239,109 @@ def fastUpdateCol(cur, column : str, table : str, values, keyCol : str, keyValue
 #   will be signicantly slower
 def updateCols(cur, columns : list, values : list, keyCol : str, table  = 'acoustics'):
 
-    # convert the columns and values lists into properly formatted strings
-    formattedColumns = "(" +  ", ".join(columns) + ")"
+    updateQuery = updateQueryString(tuple(columns), table, keyCol)
 
-    # generate a string (?,?,...?) that is as long as len(columns)
-    qMarks = "(" + ("?," * (len(columns)-1)) + "?)"
+    # the connection settings that speed up the write (WAL, temp_store = MEMORY) are set once by openDB
 
-    # Generate UPDATE query
-    # UPDATE table SET (column0,column1,...) = (?,?,...) WHERE keyCol = ?
-    updateQuery = "UPDATE " + table + " SET " + formattedColumns + " = " + qMarks + " WHERE " + keyCol + " = ?"
+    # Manually opening and closing the transaction gives a large speed increase
+    # IMMEDIATE takes the write lock when the transaction opens instead of at the first UPDATE
+    cur.execute("BEGIN IMMEDIATE")
 
-    # speed boost from using ram as temp memory and not waiting for write confirmation
-    # NOTE: this is mildly unsafe and could result in corrupted data if the program crashes mid-write
-    cur.execute("PRAGMA synchronous = OFF")
-    cur.execute("PRAGMA temp_store = MEMORY")
-    cur.execute("PRAGMA journal_mode = MEMORY")
+    # a failed update is rolled back, so the connection is not left holding the write lock in an open transaction
+    try:
+        cur.executemany(updateQuery, values)
+        cur.execute("COMMIT")
+    except:
+        cur.execute("ROLLBACK")
+        raise
 
-    # Manually opening and closing the transaction gives a large speed increase
-    cur.execute("BEGIN TRANSACTION")
 
-    cur.executemany(updateQuery, values)
+# One time conversion of older databases that saved arrays as stringified lists ('[1.1, 3.2, 4.3]')
+# Each list in columns is parsed and saved again in the binary format of Database.adaptArray, so later analysis does not
+#   need to parse the text again. Once every value of a column is binary, the column is declared as 'array' (see
+#   declareArrayColumn), so it is read back as numpy arrays by the converter registered in openDB
+# Values that are already binary (or NULL) are written back unchanged, and rows without any text values are skipped, so the
+#   conversion can be rerun if it is interrupted
+def convertTextToArrays(connection, cursor, columns : list, keyColumn = 'collection_index', table = 'acoustics'):
 
-    cur.execute("END TRANSACTION")
+    numRows = numberOfRows(cursor, table)
 
+    selectQuery = "SELECT " + ", ".join(columns + [keyColumn]) + " FROM " + table
+    res = cursor.execute(selectQuery)
+
+    # tuples of the converted arrays followed by the key, in the format used by updateCols
+    # they are written every writeChunkSize rows, so the converted arrays of the whole table are not kept in memory
+    convertedRows = []
+    numConverted = 0
+    writeCursor = connection.cursor()
+    for rows in fetchChunks(res, numRows):
+        for row in rows:
+            # each value is checked separately, so a NULL or already converted value does not stop the text values in the
+            #   other columns of the row from being converted
+            if any(type(value) == str for value in row[:-1]):
+                convertedRows.append(tuple(stringListToArray(value) if type(value) == str else value for value in row[:-1]) + (row[-1],))
+
+        if len(convertedRows) >= writeChunkSize:
+            updateCols(writeCursor, columns, convertedRows, keyColumn, table)
+            numConverted += len(convertedRows)
+            convertedRows = []
+
+    if convertedRows:
+        updateCols(writeCursor, columns, convertedRows, keyColumn, table)
+        numConverted += len(convertedRows)
+
+    for column in columns:
+        declareArrayColumn(connection, writeCursor, column, table)
+
+    return numConverted
+
+# Changes the declared type of column to 'array' if all of its values are binary arrays (or NULL)
+# sqlite cannot change the type of a column, so the data is copied to a new 'array' column, which replaces the old one
+# Columns with other values are left unchanged, and keep being converted by stringConverter
+def declareArrayColumn(connection, cursor, column : str, table = 'acoustics'):
+
+    if arrayColumnsQ(cursor, table, [column]):
+        return
+
+    nonBinaryQuery = "SELECT COUNT(*) FROM " + table + " WHERE typeof(" + column + ") NOT IN ('blob', 'null')"
+    if cursor.execute(nonBinaryQuery).fetchone()[0] > 0:
+        print("declareArrayColumn: " + column + " contains values that are not arrays. Its type was not changed")
+        return
+
+    # ALTER TABLE ... DROP COLUMN was added in sqlite 3.35. Older versions keep the binary values in the current column,
+    #   where they are still read by stringConverter
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        print("declareArrayColumn: sqlite " + sqlite3.sqlite_version + " cannot drop columns (3.35 or newer is needed). The type of " + column + " was not changed")
+        return
+
+    arrayColumn = column + "_array"
+
+    # the new column is added in the same transaction as the copy, drop and rename, so they are all rolled back together
+    #   if any of them fails. The column is never left half converted, no empty _array column is left behind, and the
+    #   connection is not left in an open transaction
+    # createNewColumn is not used since it commits
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("ALTER TABLE " + table + " ADD COLUMN " + arrayColumn + " array")
+        cursor.execute("UPDATE " + table + " SET " + arrayColumn + " = " + column)
+        cursor.execute("ALTER TABLE " + table + " DROP COLUMN " + column)
+        cursor.execute("ALTER TABLE " + table + " RENAME COLUMN " + arrayColumn + " TO " + column)
+        cursor.execute("COMMIT")
+    except:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        clearTableInfo(cursor, table)
 
 # Create a new column within a table
-def createNewColumn(con, cur, table : str, columnName : str):
+# columnType is the declared type of the column. Use 'array' for columns of numpy arrays, which are then returned as arrays
+#   by the converter registered in openDB
+def createNewColumn(con, cur, table : str, columnName : str, columnType = 'REAL'):
 
     # Create query from input
-    query = "ALTER TABLE " + table + " ADD COLUMN " + columnName + " REAL"
+    query = "ALTER TABLE " + table + " ADD COLUMN " + columnName + " " + columnType
+
+    clearTableInfo(cur, table)
 
     try:
         cur.execute(query)
@@ -162,15 +349,122 @@ def createNewColumn(con, cur, table : str, columnName : str):
     except sqlite3.OperationalError:
         print("Error creating new column. Column likely already exists. Data will be overwritten")
 
+# Makes sure that rows can be looked up by keyCol without scanning the whole table, which the UPDATE queries of the
+#   analysis functions rely on
+# An INTEGER PRIMARY KEY (i.e. collection_index) is an alias for the ROWID and is already indexed, other columns get an index
+def indexKeyColumn(con, cur, table : str, keyCol : str):
+
+    # PRAGMA table_info rows are (cid, name, type, notnull, default, pk)
+    for column in tableInfo(cur, table):
+        if column[1] == keyCol and column[2].upper() == 'INTEGER' and column[5] == 1:
+            return
+
+    cur.execute("CREATE INDEX IF NOT EXISTS " + table + "_" + keyCol + " ON " + table + " (" + keyCol + ")")
+
+# Makes sure a scan has an index on its (primaryAxis, secondaryAxis) coordinates, so pixels can be searched for by their
+#   coordinates (i.e. by fetchDataInBox) without scanning the whole table
+# Scans saved by Database already have one (acoustics_coordinates), this adds the same index to older databases
+# The axes are read from the parameters table. Raises sqlite3.OperationalError if the database is not a scan, or if the
+#   index cannot be written (i.e. the file is read only or locked). Called once by openDB
+def indexCoordinates(cur):
+
+    axes = cur.execute("SELECT primaryAxis, secondaryAxis FROM parameters").fetchone()
+    if axes is None:
+        return
+    primaryAxis, secondaryAxis = axes
+
+    # the axes are put directly into the query, so they are checked against the columns of the table first
+    if not existingColumnsQ(cur, 'acoustics', [primaryAxis, secondaryAxis]):
+        return
+
+    # PRAGMA index_list rows are (seq, name, unique, origin, partial), PRAGMA index_info rows are (seqno, cid, name)
+    # the indices are checked first, so databases that are already indexed are not written to
+    for index in cur.execute("PRAGMA index_list(acoustics)").fetchall():
+        indexColumns = [column[2] for column in cur.execute("PRAGMA index_info(" + index[1] + ")").fetchall()]
+        if indexColumns[:2] == [primaryAxis, secondaryAxis]:
+            return
+
+    cur.execute("CREATE INDEX IF NOT EXISTS acoustics_coordinates ON acoustics (" + primaryAxis + ", " + secondaryAxis + ")")
+
+# Checks whether every column in columns is declared with the 'array' type
+# Data in these columns is returned as numpy arrays by the converter registered in openDB, so it does not need stringConverter
+def arrayColumnsQ(cur, table : str, columns : list):
+
+    # PRAGMA table_info rows are (cid, name, type, notnull, default, pk)
+    columnTypes = {column[1] : column[2] for column in tableInfo(cur, table)}
+
+    return all(columnTypes.get(column, '').lower() == 'array' for column in columns)
+
+# Checks whether every column in columns exists in the table
+# Used to check column names before they are put into a query
+def existingColumnsQ(cur, table : str, columns : list):
+
+    tableColumns = {column[1] for column in tableInfo(cur, table)}
+
+    return all(column in tableColumns for column in columns)
+
+# Checks whether every column in columns is declared with a numeric type (REAL, INTEGER, INT, ...)
+# sqlite stores numbers in these columns as numbers, so the fetched values do not need stringConverter
+def numericColumnsQ(cur, table : str, columns : list):
+
+    columnTypes = {column[1] : column[2] for column in tableInfo(cur, table)}
+
+    return all(columnTypes.get(column, '').upper() in numericColumnTypes for column in columns)
+
+# declared column types checked by numericColumnsQ
+numericColumnTypes = {'REAL', 'INTEGER', 'INT', 'FLOAT', 'DOUBLE', 'NUMERIC'}
+
 # delete an existing column in a table. USE WITH CAUTION
 def deleteColumn(con, cur, table: str, columnName: str):
 
     # Create query from input
     query = "ALTER TABLE " + table + " DROP COLUMN " + columnName
 
+    clearTableInfo(cur, table)
+
     cur.execute(query)
     con.commit()
 
+# Convert column i of a list of fetched rows into a numpy array
+# The output is preallocated from the type of the first value and filled by index, instead of building
+#   a list of converted values and copying it into an array at the end
+# Scalar columns become float64 arrays and waveform columns become (rows, samples) arrays. Anything else
+#   (strings, NULLs, waveforms of different lengths) falls back to np.array on the converted values
+def columnToArray(rows, i):
+
+    numRows = len(rows)
+
+    if numRows == 0:
+        return np.array([])
+
+    firstValue = stringConverter(rows[0][i])
+
+    try:
+        if isinstance(firstValue, float):
+            formattedData = np.empty(numRows, dtype = np.float64)
+            for rowIndex in range(numRows):
+                value = stringConverter(rows[rowIndex][i])
+                if not isinstance(value, float):
+                    raise ValueError
+                formattedData[rowIndex] = value
+            return formattedData
+
+        if isinstance(firstValue, np.ndarray) and firstValue.ndim == 1:
+            formattedData = np.empty((numRows, firstValue.shape[0]), dtype = firstValue.dtype)
+            formattedData[0] = firstValue
+            for rowIndex in range(1, numRows):
+                value = stringConverter(rows[rowIndex][i])
+                if value.shape != firstValue.shape:
+                    raise ValueError
+                formattedData[rowIndex] = value
+            return formattedData
+
+    # a value that does not fit the preallocated array means the column is mixed
+    except (TypeError, ValueError, AttributeError):
+        pass
+
+    return np.array([stringConverter(row[i]) for row in rows])
+
 # Retrieve data within a column
 # TODO: update functionality to properly handle arrays
 def fetchData(cursor, column : str, table = 'acoustics'):
@@ -181,7 +475,7 @@ def fetchData(cursor, column : str, table = 'acoustics'):
     cursor.execute(selectQuery)
     rawData = cursor.fetchall()
 
-    formattedData = np.array([stringConverter(x[0]) for x in rawData])
+    formattedData = columnToArray(rawData, 0)
 
     return formattedData
 
@@ -191,83 +485,149 @@ def fetchData(cursor, column : str, table = 'acoustics'):
 #   include the coordinates in the dataColumns
 def fetchDataInBox(cursor, dataColumns : list, primaryCoorLimits : list, secondaryCoorLimits : list, primaryAxis = 'X', secondaryAxis = 'Z', table = 'acoustics'):
 
+    # the box is found with the coordinate index added by openDB (see indexCoordinates) instead of scanning the whole table
     # format the datacolumns for the query
     formattedDataColumns = ", ".join(dataColumns)
 
     # format the coor limits for the query
-    primaryBounds = primaryAxis + ' > ' + str(primaryCoorLimits[0]) + ' AND ' + primaryAxis + ' < ' + str(primaryCoorLimits[1]) + ' AND '
-    secondaryBounds = secondaryAxis + ' > ' + str(secondaryCoorLimits[0]) + ' AND ' + secondaryAxis + ' < ' + str(secondaryCoorLimits[1])
+    # the limits are passed as parameters so they are compared as numbers, without converting them to strings
+    # they are converted with float() first, since sqlite3 binds numpy scalars (i.e. np.int64, np.float32) as BLOBs, which
+    #   never compare as numbers
+    primaryBounds = primaryAxis + ' > ? AND ' + primaryAxis + ' < ? AND '
+    secondaryBounds = secondaryAxis + ' > ? AND ' + secondaryAxis + ' < ?'
     whereCondition = ' WHERE ' + primaryBounds + secondaryBounds
 
     selectQuery = 'SELECT ' + formattedDataColumns + ' FROM ' + table + whereCondition
 
-    cursor.execute(selectQuery)
+    cursor.execute(selectQuery, (float(primaryCoorLimits[0]), float(primaryCoorLimits[1]), float(secondaryCoorLimits[0]), float(secondaryCoorLimits[1])))
 
     data = cursor.fetchall()
 
     dataDict = {}
     for i in range(len(dataColumns)):
-        dataDict[dataColumns[i]] = np.array([stringConverter(x[i]) for x in data])
+        dataDict[dataColumns[i]] = columnToArray(data, i)
 
     return dataDict
 
-# Function to lookup data from dataColumns list using collection_index as the selection parameter
-#   Using collection_index is much faster than other search criteria
-def fastLookup(cursor, index: int, dataColumns: list, table='acoustics'):
+# maximum number of values bound to one query. Older versions of sqlite do not allow more than 999
+maxQueryParameters = 900
 
-    # generate a where query using the pixel's index
-    whereCondition = "collection_index = " + str(index)
+# Version of fastLookup for many indices at once
+# The indices are looked up with SELECT ... WHERE collection_index IN (?, ?, ...), up to maxQueryParameters at a time
+# Outputs a dict mapping each index that was found to a tuple of the dataColumns values
+def fastLookupMany(cursor, indices: list, dataColumns: list, table='acoustics'):
 
-    # format the datacolumns for the query
-    formattedDataColumns = ", ".join(dataColumns)
+    # the index is selected first so the rows can be matched to the requested indices
+    selectQuery = "SELECT collection_index, " + ", ".join(dataColumns) + " FROM " + table + " WHERE collection_index IN "
 
-    # Combine info into a SELECT query
-    selectQuery = "SELECT " + formattedDataColumns + " FROM " + table + " WHERE " + whereCondition
+    lookedUp = {}
+    for start in range(0, len(indices), maxQueryParameters):
+        chunk = indices[start:start + maxQueryParameters]
+        qMarks = "(" + ", ".join("?" * len(chunk)) + ")"
+        for row in cursor.execute(selectQuery + qMarks, chunk):
+            lookedUp[row[0]] = row[1:]
+
+    return lookedUp
+
+# Generates the SELECT query used by fastLookup
+# the index is passed as a parameter so the query string is the same for every pixel and sqlite can reuse the compiled statement
+#   The string is cached as well, since fastLookup is called once per pixel. dataColumns must be a tuple
+@lru_cache(maxsize = 256)
+def lookupQueryString(dataColumns : tuple, table : str):
+
+    return "SELECT " + ", ".join(dataColumns) + " FROM " + table + " WHERE collection_index = ?"
+
+# Function to lookup data from dataColumns list using collection_index as the selection parameter
+#   Using collection_index is much faster than other search criteria
+def fastLookup(cursor, index: int, dataColumns: list, table='acoustics'):
 
     # Execute query and fetch data
-    cursor.execute(selectQuery)
+    cursor.execute(lookupQueryString(tuple(dataColumns), table), (index,))
     # fetchone() is used because we are searching by primary key so only one result should return
     data = cursor.fetchone()
 
     return data
 
-# todo: update description - no longer just for strings!
-# Helper function that takes in a string returned from a table lookup and attempts to convert it to the appropriate data type
-# Only handles floats and lists right now. If it isn't recognized, it returns the unchanged string
+# Helper function that takes in a value returned from a table lookup and attempts to convert it to the appropriate data type
+# Arrays are returned unchanged, binary data and stringified lists are converted to arrays, and numbers (or strings of numbers)
+#   are returned as floats. If it isn't recognized, it returns the unchanged value
 def stringConverter(string):
 
+    # the type is checked first so the common cases do not need to raise and catch an exception
     # first check if its an ndarray and return
-    if type(string) == np.ndarray:
+    valueType = type(string)
+    if valueType == np.ndarray or valueType == float:
         return string
 
-    # Next attempt a float
-    try:
-        data = float(string)
-        return data
-    except ValueError or TypeError:
-        # it isn't a float, so try to convert a list
-        # lists are deprecated but kept in for backward compatibility
+    # binary data is an array saved by Database.adaptArray in a column that is not declared as 'array'
+    #   (i.e. a column that convertTextToArrays only partly converted)
+    if valueType == bytes:
+        return Database.convertArray(string)
+
+    if valueType == int:
+        return float(string)
+
+    # anything else that isn't a string (i.e. None) is returned unchanged
+    if valueType != str:
+        return string
+
+    # lists are deprecated but kept in for backward compatibility
+    # the parsed lists are cached, since columns like time hold the same list in every row. A copy is returned so
+    #   changing the array does not change the cached one
+    if string[:1] == '[':
         try:
-            data = stringListToArray(string)
-            return data
-        # it isn't a list either. return the string unchanged
-        except json.decoder.JSONDecodeError:
+            return cachedStringListToArray(string).copy()
+        # it isn't a list of numbers. return the string unchanged
+        except ValueError:
             return string
 
+    # Next attempt a float
+    try:
+        return float(string)
+    # it isn't a float either. return the string unchanged
+    except ValueError:
+        return string
+
 # Helper function to convert a 'stringified' list ('[1.1, 3.2, 4.3]') into a numpy array ([1.1, 3.2, 4.3])
-# Inputs the string, outputs the list
+# Inputs the string, outputs the list. Raises a ValueError if the string is not a list of numbers
 # Used to convert sql-saved lists into numpy arrays
-# TODO: in the future, saving and loading can be made smarter - save the data as binary and directly load it into an array
+# NOTE: new databases save arrays as binary (see Database.adaptArray), this is only needed for older databases
 def stringListToArray(strList : str):
 
-    # For some reason it is faster to use json.loads rather than np.fromstring
-    return np.array(json.loads(strList))
+    if strList[:1] != '[' or strList[-1:] != ']':
+        raise ValueError("stringListToArray: input is not a list: " + strList)
+
+    # np.fromstring parses the numbers between the brackets in C, which is faster than json.loads followed by np.array
+    # numpy only warns if it finds something that is not a number, so the warning is raised as an error instead of
+    #   returning a partial array
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(strList[1:-1], sep = ',')
+        except DeprecationWarning:
+            raise ValueError("stringListToArray: list contains values that are not numbers: " + strList)
+
+# Cached version of stringListToArray used by stringConverter. Only the most recent lists are kept, which is enough for
+#   repeated values like the time axis of a scan
+@lru_cache(maxsize = 16)
+def cachedStringListToArray(strList : str):
+
+    return stringListToArray(strList)
 
 
 ##########################################################################
 ########## Data Analysis #################################################
 #########################################################################
 
+# number of rows fetched at a time when iterating through a table
+fetchSize = 1000
+
+# maximum number of fetchSize chunks of results that can wait for the background write thread in applyFunctionToData
+writeQueueSize = 4
+
+# number of rows of results kept in memory by applyFunctionsToData before they are written to the database
+writeChunkSize = 4096
+
 # Applies a function to a data set by iterating through it line by line and stores the result
 # Inputs: database cursor, the function to apply to the dataset, the name of the column to store the result in
 #   the column names to retrieve the data from (a list of strings), and the name of the table to retrieve from
@@ -281,48 +641,118 @@ def applyFunctionToData(connection, cursor, func : Callable, resName : str, data
     # Create a new column in the table to hold the generated data
     createNewColumn(connection, cursor, table, resName)
 
+    # the results are written with UPDATE ... WHERE keyColumn = ?, which needs keyColumn to be indexed
+    indexKeyColumn(connection, cursor, table, keyColumn[0])
+
     # Generate and execute a db query to get the data and the primary key
     columnsToSelect = dataColumns + keyColumn
     selectQuery = "SELECT " + ", ".join(columnsToSelect) + " FROM " + table
 
+    # columns declared as arrays are already converted to numpy arrays by the converter registered in openDB
+    #   older databases that saved the data as text still need to be converted row by row
+    convertData = not arrayColumnsQ(cursor, table, dataColumns)
+
     res = cursor.execute(selectQuery)
 
-    # Track the function results and their corresponding PRIMARY KEY values in index-matched lists
+    # Track the function results of all rows
     funcResultList = []
-    keyList = []
+
+    # the results are written by a background thread, one chunk of fetchSize rows at a time, so the function can be
+    #   applied to the next chunk while the previous one is written
+    writeCursor = connection.cursor()
+    writeQueue = queue.Queue(maxsize = writeQueueSize)
+    writeErrors = []
+    writeThread = threading.Thread(target = updateColWriter, args = (writeCursor, resName, table, keyColumn[0], writeQueue, writeErrors), daemon = True)
+    writeThread.start()
 
     # Iterate through the result, convert the data to numpy arrays, apply the function, record in a list with keys
-    for i in tqdm(range(numRows)):
+    # rows are fetched fetchSize at a time, which is much faster than fetching them one by one
+    # the write thread is always stopped, even if func raises, so it is not left waiting on the queue forever
+    try:
+        for rows in fetchChunks(res, numRows):
 
-        row = res.fetchone()
+            chunkResults = applyFunctionsToChunk([func], rows, convertData, {func : funcArgs})[0]
 
-        # Initialize a list to save the data arrays
-        arrayList = []
+            # each row is a tuple of length >= 2, with the final entry being the primary key
+            chunkKeys = [row[-1] for row in rows]
 
-        # row is a tuple of length >= 2, with the final entry being the primary key
-        # convert each entry in row to an array except the final primary key
-        for i in range(len(row) - 1):
-            arrayList.append(stringConverter(row[i]))
+            funcResultList.extend(chunkResults)
+            writeQueue.put((chunkResults, chunkKeys))
 
-        # Retrieve the primary key value of the row as the last member
-        keyValue = row[-1]
+            # stop early once a write has failed, the error is raised below
+            if writeErrors:
+                break
 
-        funcResult = func(arrayList, *funcArgs)
+    finally:
+        # tell the write thread to stop and wait for it to finish
+        writeQueue.put(None)
+        writeThread.join()
 
-        funcResultList.append(funcResult)
-        keyList.append(keyValue)
+    # raise any error from the write thread here so missing results are not silently ignored
+    if writeErrors:
+        raise writeErrors[0]
 
-    # Write the results within a single transaction
-    # First open a db transaction
-    writeCursor = connection.cursor()
-    # fastUpdateCol(writeCursor, resName, table, funcResultList, keyColumn[0], keyList)
-    # connection.commit()
+    return funcResultList
 
-    fastUpdateCol(writeCursor, resName, table, funcResultList, keyColumn[0], keyList)
+# Applies each function in funcs to each row of a chunk of rows from fetchChunks
+# Each row is a tuple of the data columns followed by the primary key. funcArgs maps functions to a tuple of extra arguments
+# Outputs a list with the results of each function, index matched to funcs. The results of each function are a list
+#   index matched to rows
+# Functions with a blockFunction attribute (i.e. absoluteSum) are applied to the whole chunk in one call when the data in
+#   every row has the same shape. blockFunction gets a list with one stacked array per data column (i.e. [times, voltages]
+#   with one row per waveform) and returns an array with one result per row
+# blockFunction also gets a cache dict shared by all of the functions for the chunk, so intermediate arrays that several
+#   functions need (i.e. the hilbert envelope) are only calculated once per chunk (see cachedBlock)
+def applyFunctionsToChunk(funcs : list, rows : list, convertData : bool, funcArgs = {}):
+
+    # convert each entry in row to an array except the final primary key
+    if convertData:
+        arrayLists = [[stringConverter(row[i]) for i in range(len(row) - 1)] for row in rows]
+    else:
+        arrayLists = [list(row[:-1]) for row in rows]
 
-    # connection.commit()
+    # the data is only stacked once, the first time a function with a blockFunction needs it
+    blocks = None
+    stackable = True
+    cache = {}
 
-    return funcResultList
+    funcResults = []
+    for func in funcs:
+
+        extraArgs = funcArgs.get(func, ())
+        blockFunction = getattr(func, 'blockFunction', None)
+
+        if blockFunction is not None and stackable and blocks is None:
+            # waveforms of different lengths (or missing data) cannot be stacked, so those chunks are done row by row
+            try:
+                blocks = [np.stack(column) for column in zip(*arrayLists)]
+            except (ValueError, TypeError):
+                stackable = False
+
+        if blockFunction is not None and stackable:
+            funcResults.append(list(blockFunction(blocks, cache, *extraArgs)))
+        else:
+            funcResults.append([func(arrayList, *extraArgs) for arrayList in arrayLists])
+
+    return funcResults
+
+# runs on the background write thread of applyFunctionToData
+# writes each (values, keyValues) chunk from writeQueue into column with fastUpdateCol until None is received
+# any error is saved to writeErrors, the remaining chunks are still taken from the queue so the main thread does not block
+def updateColWriter(cur, column : str, table : str, keyCol : str, writeQueue, writeErrors : list):
+
+    while True:
+        chunk = writeQueue.get()
+        if chunk is None:
+            return
+
+        if writeErrors:
+            continue
+
+        try:
+            fastUpdateCol(cur, column, table, chunk[0], keyCol, chunk[1])
+        except Exception as e:
+            writeErrors.append(e)
 
 
 # Version of applyFunctionToData that applies muliple functions to the same data set and saves it
@@ -342,82 +772,114 @@ def applyFunctionsToData(connection, cursor, funcs : list, resNames : list, data
     for col in resNames:
         createNewColumn(connection, cursor, table, col)
 
+    # the results are written with UPDATE ... WHERE keyColumn = ?, which needs keyColumn to be indexed
+    indexKeyColumn(connection, cursor, table, keyColumn[0])
+
     # Generate and execute a db query to get the data and the primary key
     columnsToSelect = dataColumns + keyColumn
     selectQuery = "SELECT " + ", ".join(columnsToSelect) + " FROM " + table
 
+    # columns declared as arrays are already converted to numpy arrays by the converter registered in openDB
+    #   older databases that saved the data as text still need to be converted row by row
+    convertData = not arrayColumnsQ(cursor, table, dataColumns)
+
     res = cursor.execute(selectQuery)
 
     # create a list to track the values and associate keyValue for each row
     # This list will be populated with tuples which will be fed to updateCols
+    # It is written and cleared every writeChunkSize rows, so the memory used does not grow with the size of the table
     funcResultsList = []
+    writeCursor = connection.cursor()
 
     # Iterate through the result, convert the data to numpy arrays, apply the functions, and save the results
-    for i in tqdm(range(numRows)):
+    # rows are fetched fetchSize at a time, and the functions are applied to each chunk of rows at once
+    for rows in fetchChunks(res, numRows):
 
-        row = res.fetchone()
+        # Run each func (with extra arguments if func is in the funcArgs dict) on every row of the chunk
+        chunkResults = applyFunctionsToChunk(funcs, rows, convertData, funcArgs)
 
-        # Initialize a list to save the data arrays
-        arrayList = []
+        # each row is a tuple of length >= 2, with the final entry being the primary key
+        chunkKeys = [row[-1] for row in rows]
 
-        # row is a tuple of length >= 2, with the final entry being the primary key
-        # convert each entry in row to an array except the final primary key
-        for i in range(len(row) - 1):
-            arrayList.append(stringConverter(row[i]))
+        # add the keys after the results of each row
+        # This puts the results in the format [(func0(row0), func1(row0), .., key(row0)), (func0(row1), func1....]
+        # which is nice for sql queries
+        funcResultsList.extend(zip(*chunkResults, chunkKeys))
 
-        # Retrieve the primary key value of the row as the last member
-        keyValue = row[-1]
+        # write func results into their rows, each flush is its own transaction
+        if len(funcResultsList) >= writeChunkSize:
+            updateCols(writeCursor, resNames, funcResultsList, keyColumn[0], table)
+            funcResultsList = []
 
-        funcResults = []
+    # write the remaining results
+    if funcResultsList:
+        updateCols(writeCursor, resNames, funcResultsList, keyColumn[0], table)
 
-        extraArgs = ()
+# Generator that yields the rows of an executed SELECT query as lists of up to fetchSize rows
+# numRows is the expected number of rows, used to show a tqdm progress bar
+def fetchChunks(res, numRows):
 
-        for func in funcs:
+    with tqdm(total = numRows) as progressBar:
+        while True:
+            rows = res.fetchmany(fetchSize)
+            if not rows:
+                return
 
-            # Run func with extra arguments if func is in the funcArgs dict
-            if func in funcArgs:
-                funcResults.append(func(arrayList, *funcArgs[func]))
+            yield rows
+            progressBar.update(len(rows))
 
-            else:
-                funcResults.append(func(arrayList))
+# Function that runs applyFunctionsToData on multiple databases
+# Setting verbose = True will print the name of each file as it is analyzed
+# processes is the number of files analyzed at the same time in separate processes. None uses every core
+#   Each database is independent, so this speeds up the analysis of many files almost linearly
+#   NOTE: with processes != 1, funcs must be defined at the top level of a module (not lambdas) and on Windows the calling
+#   script needs an if __name__ == '__main__': guard, so the default is to analyze the files one at a time
+def analyzeDatabases(fileNames : list, funcs : list, resNames : list, dataColumns = ['time', 'voltage'], keyColumn = ['collection_index'], table = 'acoustics', funcArgs = {}, verbose = True, processes = 1):
 
-        #add the keyValue to the end of funcResults, convert it to a tuple, then append it to funcResultList
-        #This puts the results in the format [(func0(row0), func1(row0), .., key(row0)), (func0(row1), func1....]
-        # which is nice for sql queries
-        funcResults.append(keyValue)
-        funcResTuple = tuple(funcResults)
+    if processes == 1 or len(fileNames) <= 1:
+        #Iterate through filenames
+        for file in fileNames:
+            analyzeDatabase(file, funcs, resNames, dataColumns, keyColumn, table, funcArgs, verbose)
+        return
 
-        funcResultsList.append(funcResTuple)
+    if processes is None:
+        processes = min(len(fileNames), os.cpu_count())
 
-    writeCursor = connection.cursor()
-    # write func results into current row
-    updateCols(writeCursor, resNames, funcResultsList, keyColumn[0], table)
+    with ProcessPoolExecutor(max_workers = processes, initializer = initAnalysisProcess, initargs = (processes,)) as executor:
+        futures = [executor.submit(analyzeDatabase, file, funcs, resNames, dataColumns, keyColumn, table, funcArgs, verbose) for file in fileNames]
 
-    connection.commit()
+        # result() raises any error from the analysis of that file
+        for future in futures:
+            future.result()
 
-# Function that runs applyFunctionsToData on multiple databases
-# Setting verbose = True will print the name of each file as it is analyzed
-def analyzeDatabases(fileNames : list, funcs : list, resNames : list, dataColumns = ['time', 'voltage'], keyColumn = ['collection_index'], table = 'acoustics', funcArgs = {}, verbose = True):
+# Initializer of the analyzeDatabases worker processes
+# The compiled (numba) analysis functions split each chunk of rows between threads, one per core by default. With several
+#   processes running at once, each one gets an equal share of the threads instead, so the cores are not oversubscribed
+def initAnalysisProcess(processes : int):
 
-    #Iterate through filenames
-    for file in fileNames:
+    if njit is not None:
+        numba.set_num_threads(max(1, numba.config.NUMBA_NUM_THREADS // processes))
 
-        if verbose == True:
-            print("Analyzing " + file)
+# Runs applyFunctionsToData (or applyFunctionToData for a single function) on one database
+# Used by analyzeDatabases, it is a top level function so it can be sent to other processes
+def analyzeDatabase(file : str, funcs : list, resNames : list, dataColumns = ['time', 'voltage'], keyColumn = ['collection_index'], table = 'acoustics', funcArgs = {}, verbose = True):
 
-        #Create DB connection
-        con, cur = openDB(file)
+    if verbose == True:
+        print("Analyzing " + file)
 
-        #Run applyFunctionsToData
-        if len(funcs) > 1:
-            applyFunctionsToData(con, cur, funcs, resNames, dataColumns, keyColumn, table, funcArgs)
-        else:
-            applyFunctionToData(con, cur, funcs[0], resNames[0], dataColumns, keyColumn, table)
+    #Create DB connection
+    con, cur = openDB(file)
 
-        #Close connection
-        con.close()
+    #Run applyFunctionsToData
+    if len(funcs) > 1:
+        applyFunctionsToData(con, cur, funcs, resNames, dataColumns, keyColumn, table, funcArgs)
+    else:
+        applyFunctionToData(con, cur, funcs[0], resNames[0], dataColumns, keyColumn, table)
+
+    #Close connection
+    con.close()
 
-def analyzeDirectory(dir, funcs : list, resNames : list, dataColumns = ['time', 'voltage'], keyColumn = ['collection_index'], table = 'acoustics', funcArgs = {}, verbose = True):
+def analyzeDirectory(dir, funcs : list, resNames : list, dataColumns = ['time', 'voltage'], keyColumn = ['collection_index'], table = 'acoustics', funcArgs = {}, verbose = True, processes = 1):
 
     # Grab list of files with .sqlite3 extension in the folder
     files = os.listdir(dir)
@@ -427,7 +889,7 @@ def analyzeDirectory(dir, funcs : list, resNames : list, dataColumns = ['time',
             fileNames.append(os.path.join(dir, file))
 
     # Analyze gathered files
-    analyzeDatabases(fileNames, funcs, resNames , dataColumns, keyColumn, table, funcArgs, verbose)
+    analyzeDatabases(fileNames, funcs, resNames , dataColumns, keyColumn, table, funcArgs, verbose, processes)
 
 # Perform a routine set of analysis of multiscan data within a folder
 # Analysis functions: absolute_sum, arrayMax, and staltaFirstBreak(5,30,0.75)
@@ -496,20 +958,23 @@ def dataAtPixels(cursor, dataColumns: list, primaryCoors, secondaryCoors, primar
     # Convert input coordinate to a collection_index
     pixelIndices = coordinatesToCollectionIndex(cursor, primaryCoors, secondaryCoors, primaryAxis, secondaryAxis, table, verbose)
 
+    # grab the data of all pixels with one query
+    pixelData = fastLookupMany(cursor, list({index for index in pixelIndices if index is not None}), dataColumns, table)
+
     coorDict = {}
-    # iterate through pixels, grab data, convert to a dict, add to coorDict
+    # iterate through pixels, convert the data to a dict, add to coorDict
     for i in range(len(pixelIndices)):
         index = pixelIndices[i]
         coor = (primaryCoors[i], secondaryCoors[i])
         dataDict = {}
-        if index == None:
+        if index not in pixelData:
             print(
                 "fastDataAtPixels: data index is None. Check that the provided coordinates (" + str(coor[0]) + ", " + str(
                     coor[1]) + ") exist within the data set")
             for i in range(len(dataColumns)):
                 dataDict[dataColumns[i]] = None
         else:
-            data = fastLookup(cursor, index, dataColumns, table)
+            data = pixelData[index]
             for i in range(len(dataColumns)):
                 dataDict[dataColumns[i]] = stringConverter(data[i])
         coorDict[coor] = dataDict.copy()
@@ -544,6 +1009,48 @@ def coordinatesToCollectionIndex(cursor, primaryCoors : list, secondaryCoors : l
         print("coordinatesToCollectionIndex: length of primaryCoors and secondaryCoors must be equal. Returning None")
         return None
 
+    gridSteps = scanGridSteps(cursor, primaryAxis, secondaryAxis, table)
+    if gridSteps is None:
+        return None
+
+    n, xs, zs = gridSteps
+
+    # Now convert all of the input coordinates to indices at once
+    # using equation k = n(z/zs) + (x/xs)
+    x = np.asarray(primaryCoors, dtype = np.float64)
+    z = np.asarray(secondaryCoors, dtype = np.float64)
+
+    # Raise warnings if rounding
+    if verbose == True:
+        offStepX = x[np.mod(x, xs) != 0]
+        if len(offStepX) > 0:
+            print('coordinatesToCollectionIndex: primary coordinates ' + str(offStepX.tolist()) + ' are not multiples of the primary step. Rounding coordinates.')
+        offStepZ = z[np.mod(z, zs) != 0]
+        if len(offStepZ) > 0:
+            print('coordinatesToCollectionIndex: secondary coordinates ' + str(offStepZ.tolist()) + ' are not multiples of the secondary step. Rounding coordinates.')
+
+    indices = (n * (z / zs)) + (x / xs)
+
+    # indices are rounded to the nearest integer, so floating point error in the coordinates (i.e. 2.9999999) does not
+    #   truncate to the previous index
+    roundedIndices = np.rint(indices).astype(np.int64).tolist()
+
+    # handle out of bounds indices as None
+    collectionIndices = [None if index < 0 else roundedIndex for index, roundedIndex in zip(indices.tolist(), roundedIndices)]
+
+    return collectionIndices
+
+# Helper for coordinatesToCollectionIndex. Solves the coordinate steps of a scan table from its last two rows (see above)
+# Outputs (n, xs, zs), or None if they could not be found
+# The steps only depend on the table, so for connections from openDB they are cached on the connection and the queries
+#   only run once, even when coordinatesToCollectionIndex is called for one pixel at a time
+def scanGridSteps(cursor, primaryAxis = 'X', secondaryAxis = 'Z', table = 'acoustics'):
+
+    cache = getattr(cursor.connection, 'scanGridCache', None)
+    cacheKey = (table, primaryAxis, secondaryAxis)
+    if cache is not None and cacheKey in cache:
+        return cache[cacheKey]
+
     # Collect the needed constants
     # We will be using x as the primary coordinate and z as the secondary to match most common scanning data
     # (kf, xf, zf)
@@ -553,16 +1060,15 @@ def coordinatesToCollectionIndex(cursor, primaryCoors : list, secondaryCoors : l
         print("coordinatesToCollectionIndex: input table only has one row. Check that the table and data are correct")
         return None
     # xf, zf == coordinates at kf
-    formattedCoordinates = primaryAxis + ", " + secondaryAxis
-    xfzfQuery = "SELECT " + formattedCoordinates + " FROM " + table + " WHERE collection_index = " + str(kf)
-    xfzfTuple = cursor.execute(xfzfQuery).fetchone()
+    # fastLookup passes the index as a parameter, so both lookups use the same compiled statement
+    coordinateColumns = [primaryAxis, secondaryAxis]
+    xfzfTuple = fastLookup(cursor, kf, coordinateColumns, table)
     xf = xfzfTuple[0]
     zf = xfzfTuple[1]
 
     # collect a second set of (k, x, z) at the second to last coordinate
     k0 = kf - 1
-    x0z0Query = "SELECT " + formattedCoordinates + " FROM " + table + " WHERE collection_index = " + str(k0)
-    x0z0Tuple = cursor.execute(x0z0Query).fetchone()
+    x0z0Tuple = fastLookup(cursor, k0, coordinateColumns, table)
     x0 = x0z0Tuple[0]
     z0 = x0z0Tuple[1]
 
@@ -583,29 +1089,35 @@ def coordinatesToCollectionIndex(cursor, primaryCoors : list, secondaryCoors : l
         print("coordinatesToCollectionIndex: unable to identify coordinate step. Unclear what went wrong, but its probably related to floating point rounding. Your data is probably cursed, contact Sam for an exorcism (or debugging).")
         return None
 
-    # Now iterate through the input coordinates and convert to indices
-    # using equation k = n(z/zs) + (x/xs)
-    collectionIndices = []
+    if cache is not None:
+        cache[cacheKey] = (n, xs, zs)
 
-    for i in range(len(primaryCoors)):
-        x = primaryCoors[i]
-        # Raise warnings if rounding
-        if verbose == True and (x % xs != 0):
-            print('coordinatesToCollectionIndex: primary coordinate ' + str(x) + 'is not a multiple of the primary step. Rounding coordinate.')
+    return n, xs, zs
 
-        z = secondaryCoors[i]
-        if verbose == True and (z % zs != 0):
-            print('coordinatesToCollectionIndex: secondary coordinate ' + str(z) + 'is not a multiple of the secondary step. Rounding coordinate.')
+# Merges a list of {coordinate : {dataColumn : value}} dicts, one per scan, into a single dict of the same shape where each
+#   value is the array of the values of every scan, index matched to the order of dataDictList
+# Values are collected in lists and converted once at the end. Appending to a numpy array every scan copies all of the
+#   previous scans each time
+# np.stack converts every value with np.asarray, so arrays become a (scans, samples) array and scalars (python or numpy
+#   floats, ints, None) become a 1D array without checking their type
+def mergeScanData(dataDictList : list):
 
-        index = (n * (z / zs)) + (x / xs)
+    masterLists = {}
 
-        # handle out of bounds indices as None
-        if index < 0:
-            collectionIndices.append(None)
-        else:
-            collectionIndices.append(int(index))
+    for scan in dataDictList:
+        for coor, coordinateData in scan.items():
+            coordinateLists = masterLists.setdefault(coor, {})
+            for dataColumn, value in coordinateData.items():
+                coordinateLists.setdefault(dataColumn, []).append(value)
 
-    return collectionIndices
+    masterDict = {}
+
+    for coor, coordinateLists in masterLists.items():
+        masterDict[coor] = {}
+        for dataColumn, values in coordinateLists.items():
+            masterDict[coor][dataColumn] = np.stack(values)
+
+    return masterDict
 
 # Runs dataAtPixels across multiple scans,
 # Returns a dict with the keys as (x,y) coordinates, and the values as a dict with keys as data columns and values as a numpy array
@@ -628,25 +1140,8 @@ def multiScanDataAtPixels(fileNames : list, dataColumns : list, primaryCoors : l
 
         con.close()
 
-    # Merge data. storage list is a list of dicts of dicts. This got ugly...
-    # First make a copy of dataDictList[0] but with the values as numpy arrays
-    masterDict = {}
-
-    for coordinate, coordinateData in dataDictList[0].items():
-        masterDict[coordinate] = {dataColumn : np.array(value) for dataColumn, value in coordinateData.items()}
-
-    # Now iterate through the rest of dataDictList, merging the values into the arrays of masterDict
-    for scan in dataDictList[1:]:
-
-        # for each scan in list, iterate through the keys (coordinates) and values (values == innerDict of data columns)
-        for coor, coordinateData in scan.items():
-
-            # set the value of masterDict[coordinate/key][data column / inn
-            for dataColumn, value in coordinateData.items():
-                if type(value) == float:
-                    masterDict[coor][dataColumn] = np.append(masterDict[coor][dataColumn], value)
-                elif type(value) == np.ndarray:
-                    masterDict[coor][dataColumn] = np.vstack((masterDict[coor][dataColumn], value))
+    # Merge data. storage list is a list of dicts of dicts
+    masterDict = mergeScanData(dataDictList)
 
     return masterDict
 
@@ -699,7 +1194,8 @@ def plotRepeatPulseData(cursor, xCol : str, yCol : str, table = 'acoustics'):
         minTime = min(xDat)
         xDat = (xDat - minTime) / 3600
 
-    plt.scatter(xDat, yDat)
+    # markers without a line, drawn faster than plt.scatter since every point has the same style
+    plt.plot(xDat, yDat, 'o')
     plt.show()
 
 # def plotRepeatPulseWaveOverTime(cursor, xCol: str, yCol: str, table='acoustics'):
@@ -749,14 +1245,20 @@ def plotPixelsWaveform(cursor, primaryCoors : list, secondaryCoors : list, prima
     # get the pixel indices
     pixelIndices =  coordinatesToCollectionIndex(cursor, primaryCoors, secondaryCoors, primaryAxis, secondaryAxis, table, True)
 
-    # gather and plot data at each pixel
+    # gather the data of all pixels with one query
+    pixelData = fastLookupMany(cursor, list({index for index in pixelIndices if index is not None}), [xCol, yCol], table)
+
+    # plot data at each pixel
     for i in range(len(primaryCoors)):
 
         coor = (primaryCoors[i], secondaryCoors[i])
         pixel = pixelIndices[i]
 
-        # gather the data
-        data = fastLookup(cursor, pixel, [xCol, yCol], table)
+        if pixel not in pixelData:
+            print("plotPixelsWaveform: no data found. Check that the provided coordinates " + str(coor) + " exist within the data set")
+            continue
+
+        data = pixelData[pixel]
 
         # convert the data to a numpy array
         xDat = stringConverter(data[0])
@@ -778,36 +1280,42 @@ def plotRepeatWaveforms(cursor, xCol='time', yCol='voltage', colorCol = 'time_co
     yData = fetchData(cursor, yCol, table)
     cData = fetchData(cursor, colorCol, table)
 
-    # shift the color data so it is zero-referenced and then normalize it for color mapping
+    # shift the color data so it is zero-referenced, in hours
     minTime = np.min(cData)
     cDatZero = (cData - minTime) / 3600
-    maxTime = np.max(cDatZero)
-    normDat = cDatZero/maxTime
 
-    for i in range(len(cData)):
-        plt.plot(xData[i], yData[i], c = cmp['viridis'](normDat[i]))
+    plotColormappedWaveforms(xData, yData, cDatZero, "Time (h)")
 
     plt.show()
 
+# Plots a stack of waveforms as a single LineCollection, colored by colorData with the viridis colormap
+# A single artist draws much faster than one plt.plot line per waveform, and the colorbar replaces a legend entry per waveform
+# xData and yData are sequences of the x and y arrays of each waveform, colorData has one value per waveform
+def plotColormappedWaveforms(xData, yData, colorData, colorLabel = ''):
+
+    segments = [np.column_stack((x, y)) for x, y in zip(xData, yData)]
+
+    lines = LineCollection(segments, array = np.asarray(colorData), cmap = 'viridis')
+
+    axes = plt.gca()
+    axes.add_collection(lines)
+    axes.autoscale()
+    plt.colorbar(lines, ax = axes, label = colorLabel)
+
 # Plots the waveform at a specific single pixel
 def plotPixelWaveformOverTime(dir, primaryCoor, secondaryCoor, primaryAxis = 'X', secondaryAxis = 'Z', xCol = 'time', yCol = 'voltage', table = 'acoustics'):
 
     dataDict = directoryScanDataAtPixels(dir, [xCol, yCol, 'time_collected'], [primaryCoor], [secondaryCoor], primaryAxis, secondaryAxis,
                                          table, verbose = True)
 
-    # Convert time_collected to a common zero, then normalize it to [0,1] for use in colormaps'
+    # Convert time_collected to a common zero in hours, used for the colormap
     timesCollected = dataDict[(primaryCoor, secondaryCoor)]['time_collected']
     minTime = min(timesCollected)
     timesCollectZeroRef = timesCollected - minTime
-    maxTime = max(timesCollectZeroRef)
-    normTime = timesCollectZeroRef/maxTime
 
     for coor in dataDict.keys():
-        for wave in range(len(dataDict[coor][xCol])):
-            plt.plot(dataDict[coor][xCol][wave], dataDict[coor][yCol][wave],
-                     c = cmp['viridis'](normTime[wave]),
-                     label = round(timesCollectZeroRef[wave]/3600, 2))
-    plt.legend()
+        plotColormappedWaveforms(dataDict[coor][xCol], dataDict[coor][yCol], timesCollectZeroRef/3600, "Time (h)")
+
     plt.show()
 
 
@@ -820,66 +1328,69 @@ def plotScanDataAtPixels(dir : str, dataColumns : list, primaryCoors : list, sec
 
     dataDict = directoryScanDataAtPixels(dir, dataColumns, primaryCoors, secondaryCoors, primaryAxis, secondaryAxis, table, verbose)
 
+    # every coordinate has one value per scan, so the data is stacked into (coordinates, scans) arrays and the time
+    #   conversion and normalization are done once for all coordinates
+    coors = list(dataDict.keys())
+    xData = np.stack([dataDict[coor][dataColumns[0]] for coor in coors])
+    yData = np.stack([dataDict[coor][dataColumns[1]] for coor in coors])
+
+    if normalized == True:
+        # divide all coors by the values of the first coordinate
+        yData = yData / dataDict[(primaryCoors[0], secondaryCoors[0])][dataColumns[1]]
+
     # Convert time axis to a common zero if the x-axis is experiment time'
     if dataColumns[0] == 'time_collected':
-        minTimes = []
-        for coor in dataDict:
-            times = dataDict[coor]['time_collected']
-            # Collect the first time (which should be the minimum)
-            minTimes.append(times[0])
+        # Find the experiment start time by taking the min of the first time of each coordinate (which should be its minimum)
+        t0 = np.min(xData[:, 0])
 
-        # Find the experiment start time by taking the min of the mins
-        t0 = min(minTimes)
+        # Convert to common 0 by subtracting start time. Divide by 3600 to display in hours instead of seconds
+        xData = (xData - t0)/3600
 
-    if normalized == True:
-        # grab values from first coordinate
-        normValue = dataDict[(primaryCoors[0], secondaryCoors[0])][dataColumns[1]]
-        # iterate through all coors and divide by first coordinate
-        for coor in dataDict.keys():
-            # be wary of issues with copy and references here - may need to revise
-            dataDict[coor][dataColumns[1]] = dataDict[coor][dataColumns[1]]/normValue
+    scatterGroups(xData.ravel(), yData.ravel(), [xData.shape[1]] * len(coors), [str(coor) for coor in coors])
 
-    for coor in dataDict.keys():
-        if dataColumns[0] == 'time_collected':
-            # Convert to common 0 by subtracting start time. Divide by 3600 to display in hours instead of seconds
-            plt.scatter((dataDict[coor][dataColumns[0]] - t0)/3600, dataDict[coor][dataColumns[1]], label = str(coor))
-        else:
-            plt.scatter(dataDict[coor][dataColumns[0]], dataDict[coor][dataColumns[1]], label=str(coor))
+    plt.show()
+
+# Plots several groups of points, with one color and legend entry per group
+# xData and yData are the concatenated data of every group, groupSizes the number of points in each group, and labels the
+#   legend label of each group
+# Each group is drawn with plt.plot markers instead of plt.scatter. All markers of a group have the same size and color,
+#   so a single Line2D draws them much faster than a scatter PathCollection with per-point styling
+def scatterGroups(xData, yData, groupSizes : list, labels : list):
+
+    groupEnds = np.cumsum(groupSizes)[:-1]
+
+    for xGroup, yGroup, label in zip(np.split(xData, groupEnds), np.split(yData, groupEnds), labels):
+        plt.plot(xGroup, yGroup, 'o', label = label)
 
     plt.legend()
-    plt.show()
 
 def baselineTest(dir : str, dataColumns : list, primaryCoors : list, secondaryCoors : list, primaryAxis = 'X',  secondaryAxis = 'Z', table = 'acoustics', verbose = True, normalized = False):
 
     dataDict = directoryScanDataAtPixels(dir, dataColumns, primaryCoors, secondaryCoors, primaryAxis, secondaryAxis, table, verbose)
 
+    # every coordinate has one value per scan, so the data is stacked into (coordinates, scans) arrays and the time
+    #   conversion and normalization are done once for all coordinates
+    coors = list(dataDict.keys())
+    xData = np.stack([dataDict[coor][dataColumns[0]] for coor in coors])
+    yData = np.stack([dataDict[coor][dataColumns[1]] for coor in coors])
+
+    if normalized == True:
+        # divide all coors by the values of the first coordinate
+        yData = yData / dataDict[(primaryCoors[0], secondaryCoors[0])][dataColumns[1]]
+
     # Convert time axis to a common zero if the x-axis is experiment time'
     if dataColumns[0] == 'time_collected':
-        minTimes = []
-        for coor in dataDict:
-            times = dataDict[coor]['time_collected']
-            # Collect the first time (which should be the minimum)
-            minTimes.append(times[0])
+        # Find the experiment start time by taking the min of the first time of each coordinate (which should be its minimum)
+        t0 = np.min(xData[:, 0])
 
-        # Find the experiment start time by taking the min of the mins
-        t0 = min(minTimes)
+        # Convert to common 0 by subtracting start time. Divide by 3600 to display in hours instead of seconds
+        xData = (xData - t0)/3600
 
-    if normalized == True:
-        # grab values from first coordinate
-        normValue = dataDict[(primaryCoors[0], secondaryCoors[0])][dataColumns[1]]
-        # iterate through all coors and divide by first coordinate
-        for coor in dataDict.keys():
-            # be wary of issues with copy and references here - may need to revise
-            dataDict[coor][dataColumns[1]] = dataDict[coor][dataColumns[1]]/normValue
+        # subtract the baseline column
+        yData = yData - np.stack([dataDict[coor][dataColumns[2]] for coor in coors])
 
-    for coor in dataDict.keys():
-        if dataColumns[0] == 'time_collected':
-            # Convert to common 0 by subtracting start time. Divide by 3600 to display in hours instead of seconds
-            plt.scatter((dataDict[coor][dataColumns[0]] - t0)/3600, dataDict[coor][dataColumns[1]] -  dataDict[coor][dataColumns[2]], label = str(coor))
-        else:
-            plt.scatter(dataDict[coor][dataColumns[0]], dataDict[coor][dataColumns[1]], label=str(coor))
+    scatterGroups(xData.ravel(), yData.ravel(), [xData.shape[1]] * len(coors), [str(coor) for coor in coors])
 
-    plt.legend()
     plt.show()
 
 # plot a map
@@ -888,33 +1399,69 @@ def baselineTest(dir : str, dataColumns : list, primaryCoors : list, secondaryCo
 # todo: put limits on the z/color axis to allow easier comparison between scans
 def plot2DScan(cursor, xCol : str, yCol : str, datCol : str, datRange = [None, None], save = False, show = True, fileName = '', table = 'acoustics'):
 
-    # Format the requested columns for the db query
-    columns = xCol + ', ' + yCol + ', ' + datCol
-
-    # Formate and execute SELECt query
-    selectQuery = "SELECT " + columns + " FROM " + table
-
-    rawData = cursor.execute(selectQuery).fetchall()
-
-    xDat = np.array([])
-    yDat = np.array([])
-    cDat = np.array([])
-
-    for row in rawData:
-        xDat = np.append(xDat, stringConverter(row[0]))
-        yDat = np.append(yDat, stringConverter(row[1]))
-        cDat = np.append(cDat, stringConverter(row[2]))
-
-    if datRange[0] != None or datRange[1] != None:
-        cDat = np.clip(cDat, datRange[0], datRange[1])
-
+    # the column names are put directly into the query, so they are checked against the columns of the table first
+    if not existingColumnsQ(cursor, table, [xCol, yCol, datCol]):
+        print("plot2DScan: " + table + " does not contain all of the columns " + str([xCol, yCol, datCol]))
+        return -1
 
-    plt.scatter(xDat, yDat, c = cDat)
-    plt.colorbar()
+    # numeric columns are fetched fetchSize rows at a time straight into a preallocated float array (NULL values become NaN)
+    #   so the whole result is never held as a list of tuples
+    if numericColumnsQ(cursor, table, [xCol, yCol, datCol]):
+        # the datRange limits are applied by sqlite with the scalar MAX / MIN functions, so the values arrive already clipped
+        datExpression = datCol
+        clipLimits = []
+        if datRange[0] != None:
+            datExpression = "MAX(" + datExpression + ", ?)"
+            clipLimits.append(datRange[0])
+        if datRange[1] != None:
+            datExpression = "MIN(" + datExpression + ", ?)"
+            clipLimits.append(datRange[1])
+
+        selectQuery = "SELECT " + xCol + ", " + yCol + ", " + datExpression + " FROM " + table
+
+        plotData = np.empty((numberOfRows(cursor, table), 3))
+
+        res = cursor.execute(selectQuery, clipLimits)
+        filledRows = 0
+        while True:
+            rows = res.fetchmany(fetchSize)
+            if not rows:
+                break
+            plotData[filledRows:filledRows + len(rows)] = rows
+            filledRows += len(rows)
+
+        xDat, yDat, cDat = plotData[:filledRows].T
+
+    # otherwise convert each column once into a preallocated array, rather than growing the arrays with np.append for every row
+    # the values can be stored as TEXT (i.e. in older databases), which sqlite sorts above every number, so the datRange
+    #   limits are applied with np.clip after the conversion instead of in the query
+    else:
+        rawData = cursor.execute("SELECT " + xCol + ", " + yCol + ", " + datCol + " FROM " + table).fetchall()
+
+        xDat = columnToArray(rawData, 0)
+        yDat = columnToArray(rawData, 1)
+        cDat = columnToArray(rawData, 2)
+
+        if datRange[0] != None or datRange[1] != None:
+            cDat = np.clip(cDat, datRange[0], datRange[1])
+
+    # the plot gets its own figure, so saving many plots in a loop closes exactly the figure that was drawn
+    # plots that are only saved (i.e. from generate2DScans) are drawn on a Figure that pyplot does not manage. It is saved
+    #   with the non-interactive canvas for the file format (Agg for '.png'), so no GUI window is set up, and the
+    #   pyplot backend and the figures the user has open are left alone
+    # rasterized = True draws the points as an image, so vector formats (i.e. '.svg', '.pdf') do not store a path for
+    #   every pixel of the scan
+    if save == True and show != True:
+        figure = Figure()
+        axes = figure.subplots()
+    else:
+        figure, axes = plt.subplots()
+    points = axes.scatter(xDat, yDat, c = cDat, rasterized = True)
+    figure.colorbar(points, ax = axes)
 
     if save == True:
-        plt.savefig(fileName)
-        plt.close()
+        figure.savefig(fileName)
+        plt.close(figure)
 
     if show == True:
         plt.show()
@@ -922,37 +1469,59 @@ def plot2DScan(cursor, xCol : str, yCol : str, datCol : str, datRange = [None, N
 # Function to generate plots from several DB files.
 # Saves plots from multiple files and can handle multiple data columns to plot as the z (color) axis
 # Save the plots as datCol//fileName_datCol
-def generate2DScans(fileNames : list, xCol : str, yCol : str, datCols : list, datRange = [None, None],  format = '.png', verbose = True):
+# processes is the number of files plotted at the same time in separate processes. None uses every core
+#   NOTE: on Windows the calling script needs an if __name__ == '__main__': guard when processes != 1
+# The plots are only saved, so plot2DScan draws them without pyplot (see plot2DScan) and the backend is not changed
+def generate2DScans(fileNames : list, xCol : str, yCol : str, datCols : list, datRange = [None, None],  format = '.png', verbose = True, processes = 1):
 
-    for file in fileNames:
+    if processes == 1 or len(fileNames) <= 1:
+        for file in fileNames:
+            generate2DScansFile(file, xCol, yCol, datCols, datRange, format, verbose)
 
-        if verbose == True:
-            print("Plotting " + file)
+        return
 
-        # Open database connection
-        con, cur = openDB(file)
+    if processes is None:
+        processes = min(len(fileNames), os.cpu_count())
 
-        for dat in datCols:
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        futures = [executor.submit(generate2DScansFile, file, xCol, yCol, datCols, datRange, format, verbose) for file in fileNames]
 
-            # Generate the save filename for each plot
-            # Puts each different type of data plot in a separate folder for easier organization
-            saveDir = os.path.dirname(file) + '//' + dat + '//'
+        # result() raises any error from the plots of that file
+        for future in futures:
+            future.result()
 
-            # make the saveDir if it doesn't exist
-            if not os.path.exists(saveDir):
-                os.makedirs(saveDir)
+# Saves the plots of generate2DScans for one file
+# Used by generate2DScans, it is a top level function so it can be sent to other processes
+def generate2DScansFile(file : str, xCol : str, yCol : str, datCols : list, datRange = [None, None],  format = '.png', verbose = True):
 
-            # Generate savename by gathering the basename, removing the exension, adding the data column name and format extension
-            saveName = os.path.basename(os.path.splitext(file)[0]) + dat + format
-            saveFile = saveDir + saveName
+    if verbose == True:
+        print("Plotting " + file)
 
-            # run plot2dscan with save = True and show = False
-            plot2DScan(cur, xCol, yCol, dat, datRange, save = True, show = False, fileName = saveFile)
+    # Open database connection
+    con, cur = openDB(file)
 
-        # Close db connection
-        con.close()
+    for dat in datCols:
 
-def generate2DScansDirectory(dir, xCol : str, yCol : str, datCols : list, datRange = [None, None],  format = '.png', verbose = True):
+        # Generate the save filename for each plot
+        # Puts each different type of data plot in a separate folder for easier organization
+        saveDir = os.path.dirname(file) + '//' + dat + '//'
+
+        # make the saveDir if it doesn't exist
+        # exist_ok since another process can create the folder between the check and makedirs
+        if not os.path.exists(saveDir):
+            os.makedirs(saveDir, exist_ok = True)
+
+        # Generate savename by gathering the basename, removing the exension, adding the data column name and format extension
+        saveName = os.path.basename(os.path.splitext(file)[0]) + dat + format
+        saveFile = saveDir + saveName
+
+        # run plot2dscan with save = True and show = False
+        plot2DScan(cur, xCol, yCol, dat, datRange, save = True, show = False, fileName = saveFile)
+
+    # Close db connection
+    con.close()
+
+def generate2DScansDirectory(dir, xCol : str, yCol : str, datCols : list, datRange = [None, None],  format = '.png', verbose = True, processes = 1):
 
     # Grab list of files with .sqlite3 extension in the folder
     files = os.listdir(dir)
@@ -962,7 +1531,7 @@ def generate2DScansDirectory(dir, xCol : str, yCol : str, datCols : list, datRan
             fileNames.append(os.path.join(dir, file))
 
     # run multiGenerateScanPlots with the list of fileNames
-    generate2DScans(fileNames, xCol, yCol, datCols, datRange,  format, verbose)
+    generate2DScans(fileNames, xCol, yCol, datCols, datRange,  format, verbose, processes)
 
 ##########################################################################33
 ############### Analysis Functions #########################################
@@ -971,7 +1540,22 @@ def generate2DScansDirectory(dir, xCol : str, yCol : str, datCols : list, datRan
 
 # Simple function to take the sum of the absolute values of the 'y' values
 def absoluteSum(arrList):
-    return bn.nansum(abs(arrList[1]))
+
+    if njit is not None:
+        return absoluteSumKernel(arrList[1])
+
+    return bn.nansum(np.abs(arrList[1]))
+
+# compiled loop for absoluteSum, which sums the absolute values without allocating an array for them
+# NaN values are skipped, matching bn.nansum
+if njit is not None:
+    @njit(cache = True)
+    def absoluteSumKernel(y):
+        total = 0.0
+        for i in range(y.size):
+            if not np.isnan(y[i]):
+                total += abs(y[i])
+        return total
 
 # Return the  max of the y-values
 def arrayMax(arrList):
@@ -990,6 +1574,63 @@ def endMean(arrList, n = 5):
 
     return np.mean(lastN)
 
+# Versions of the functions above that are applied to a whole chunk of rows at once (see applyFunctionToChunk)
+# blocks[1] holds the y-values with one row per waveform, so each reduction is taken along axis 1
+# With numba, absoluteSum, arrayMax and maxMinusMin share one compiled pass over the chunk (see waveStatsKernel), so
+#   requesting several of them only reads the waveforms once
+if njit is not None:
+    absoluteSum.blockFunction = lambda blocks, cache: waveStats(blocks, cache)[0]
+    arrayMax.blockFunction = lambda blocks, cache: waveStats(blocks, cache)[1]
+    maxMinusMin.blockFunction = lambda blocks, cache: waveStats(blocks, cache)[1] - waveStats(blocks, cache)[2]
+else:
+    absoluteSum.blockFunction = lambda blocks, cache: bn.nansum(np.abs(blocks[1]), axis = 1)
+    arrayMax.blockFunction = lambda blocks, cache: bn.nanmax(blocks[1], axis = 1)
+    maxMinusMin.blockFunction = lambda blocks, cache: bn.nanmax(blocks[1], axis = 1) - bn.nanmin(blocks[1], axis = 1)
+endMean.blockFunction = lambda blocks, cache, n = 5: np.mean(blocks[1][:, -n:], axis = 1)
+
+# Returns the (absolute sums, maxima, minima) of each row of the chunk, calculated once per chunk
+def waveStats(blocks, cache : dict):
+
+    return cachedBlock(cache, 'waveStats', lambda: waveStatsKernel(blocks[1]))
+
+# compiled loop that finds the sum of the absolute values, the maximum and the minimum of each row in one pass
+# NaN values are skipped, matching bn.nansum, bn.nanmax and bn.nanmin. Rows without any numbers have a NaN max and min
+if njit is not None:
+    @njit(cache = True, parallel = True)
+    def waveStatsKernel(values):
+
+        stats = np.empty((3, values.shape[0]))
+
+        for row in prange(values.shape[0]):
+            total = 0.0
+            maximum = -np.inf
+            minimum = np.inf
+            numbers = 0
+            for i in range(values.shape[1]):
+                value = values[row, i]
+                if not np.isnan(value):
+                    total += abs(value)
+                    if value > maximum:
+                        maximum = value
+                    if value < minimum:
+                        minimum = value
+                    numbers += 1
+
+            stats[0, row] = total
+            stats[1, row] = maximum if numbers > 0 else np.nan
+            stats[2, row] = minimum if numbers > 0 else np.nan
+
+        return stats
+
+# Helper for the block analysis functions. Returns cache[key], calling compute() to fill it the first time
+# Intermediate arrays are cached under a key that includes any parameters they depend on, i.e. ('stalta', 5, 30)
+def cachedBlock(cache : dict, key, compute : Callable):
+
+    if key not in cache:
+        cache[key] = compute()
+
+    return cache[key]
+
 # Calculate the time of the first break using STA/LTA algorithm
 # Inputs the arrayList from applyFunctionToData, the length (in number of elements, NOT time) of the short and long averaging window,
 #   and tresholdRatio, a number in (0,1) that determines what fraction of the maximum STA/LTA counts as the first break
@@ -1004,18 +1645,117 @@ def staltaFirstBreak(arrayList, shortWindow : int, longWindow : int, thresholdRa
     threshold = thresholdRatio * bn.nanmax(staltaArray)
 
     # Return time where first value in staltaArray is above threshold
-    for i in range(len(staltaArray)):
-        if staltaArray[i] > threshold:
-            return timeData[i]
+    # argmax gives the first True (or 0 if there are none)
+    aboveThreshold = staltaArray > threshold
+    firstIndex = np.argmax(aboveThreshold)
+    if aboveThreshold[firstIndex]:
+        return timeData[firstIndex]
 
     # No value was found above threshold. Return -1
     return -1
 
-def hilbertEnvelope(arrList):
+# Version of staltaFirstBreak applied to a whole chunk of rows at once (see applyFunctionsToChunk)
+def staltaFirstBreakBlock(blocks, cache : dict, shortWindow : int, longWindow : int, thresholdRatio = 0.75):
+
+    timeData = blocks[0]
+
+    # the compiled version finds the first break of each row without building the STA/LTA array
+    if njit is not None and ('stalta', shortWindow, longWindow) not in cache:
+        return staltaFirstBreakKernel(timeData, blocks[1], shortWindow, longWindow, thresholdRatio, -1.0)
+
+    # stalta works along the last axis, so each row is processed separately
+    staltaArray = cachedBlock(cache, ('stalta', shortWindow, longWindow), lambda: stalta(blocks[1], shortWindow, longWindow))
+
+    threshold = thresholdRatio * bn.nanmax(staltaArray, axis = 1)
+
+    # index of the first value above threshold in each row, and -1 where there is none
+    return firstIndexAbove(staltaArray, threshold, timeData, -1)
+
+staltaFirstBreak.blockFunction = staltaFirstBreakBlock
+
+# compiled version of staltaFirstBreakBlock, with the rows split between threads
+# the STA and LTA of each row are kept as running sums of the squared values, which are walked twice: once to find the
+#   maximum STA/LTA and once to find the first value above the threshold. Values before the long window is full are
+#   skipped, like the NaN values from bn.move_mean
+# NaN samples are counted instead of summed (as bn.move_mean does), so only the windows containing a NaN are skipped
+# error_model = 'numpy' gives inf/NaN for a zero LTA (as numpy does) instead of raising ZeroDivisionError
+if njit is not None:
+    @njit(cache = True, parallel = True, error_model = 'numpy')
+    def staltaFirstBreakKernel(times, values, shortWindow, longWindow, thresholdRatio, notFound):
+
+        results = np.empty(values.shape[0])
+
+        for row in prange(values.shape[0]):
+            y = values[row]
+            firstFull = max(shortWindow, longWindow) - 1
+
+            # first pass, find the maximum STA/LTA
+            maxRatio = -np.inf
+            staSum = 0.0
+            ltaSum = 0.0
+            staNans = 0
+            ltaNans = 0
+            for i in range(y.size):
+                square = y[i] * y[i]
+                if np.isnan(square):
+                    staNans += 1
+                    ltaNans += 1
+                else:
+                    staSum += square
+                    ltaSum += square
+                if i >= shortWindow:
+                    square = y[i - shortWindow] * y[i - shortWindow]
+                    if np.isnan(square):
+                        staNans -= 1
+                    else:
+                        staSum -= square
+                if i >= longWindow:
+                    square = y[i - longWindow] * y[i - longWindow]
+                    if np.isnan(square):
+                        ltaNans -= 1
+                    else:
+                        ltaSum -= square
+                if i >= firstFull and staNans == 0 and ltaNans == 0:
+                    ratio = (staSum / shortWindow) / (ltaSum / longWindow)
+                    if ratio > maxRatio:
+                        maxRatio = ratio
+
+            # second pass, find the first STA/LTA above the threshold
+            threshold = thresholdRatio * maxRatio
+            results[row] = notFound
+            staSum = 0.0
+            ltaSum = 0.0
+            staNans = 0
+            ltaNans = 0
+            for i in range(y.size):
+                square = y[i] * y[i]
+                if np.isnan(square):
+                    staNans += 1
+                    ltaNans += 1
+                else:
+                    staSum += square
+                    ltaSum += square
+                if i >= shortWindow:
+                    square = y[i - shortWindow] * y[i - shortWindow]
+                    if np.isnan(square):
+                        staNans -= 1
+                    else:
+                        staSum -= square
+                if i >= longWindow:
+                    square = y[i - longWindow] * y[i - longWindow]
+                    if np.isnan(square):
+                        ltaNans -= 1
+                    else:
+                        ltaSum -= square
+                if i >= firstFull and staNans == 0 and ltaNans == 0 and (staSum / shortWindow) / (ltaSum / longWindow) > threshold:
+                    results[row] = times[row, i]
+                    break
+
+        return results
 
-    hilbertTransform = hilbert(arrList[1])
+def hilbertEnvelope(arrList):
 
-    return np.abs(hilbertTransform)
+    return analyticEnvelope(arrList[1])
 
 # method to calculate the time of flight by calculating the function envelope using a
 # hilbert transform and finding the time where the envelope reaches a certain fraction of
@@ -1026,13 +1766,65 @@ def envelopeThresholdTOF(arrList, threshold = 0.1):
 
     thresh = threshold * bn.nanmax(envelope)
 
-    for i in range(len(envelope)):
-        if envelope[i] > thresh:
-            return arrList[0][i]
+    aboveThreshold = envelope > thresh
+    firstIndex = np.argmax(aboveThreshold)
+    if aboveThreshold[firstIndex]:
+        return arrList[0][firstIndex]
 
     print("envelopeThresholdTOF: no value was found above the threshold. Check that 0 < threshold < 1")
     return 0
 
+# Version of envelopeThresholdTOF applied to a whole chunk of rows at once (see applyFunctionsToChunk)
+def envelopeThresholdTOFBlock(blocks, cache : dict, threshold = 0.1):
+
+    envelope = cachedBlock(cache, 'envelope', lambda: analyticEnvelope(blocks[1]))
+
+    thresh = threshold * bn.nanmax(envelope, axis = 1)
+
+    tofs = firstIndexAbove(envelope, thresh, blocks[0], np.nan)
+
+    # the rows without a value above the threshold get 0, like envelopeThresholdTOF
+    notFound = np.isnan(tofs)
+    if np.any(notFound):
+        print("envelopeThresholdTOF: no value was found above the threshold. Check that 0 < threshold < 1")
+        tofs[notFound] = 0
+
+    return tofs
+
+envelopeThresholdTOF.blockFunction = envelopeThresholdTOFBlock
+
+# Helper for the block analysis functions. For each row of values, finds the first value above the threshold of that row
+# Outputs the entry of times at the same position, or notFound for rows where no value is above the threshold
+def firstIndexAbove(values, thresholds, times, notFound):
+
+    # the compiled version stops each row at the first value above the threshold, without building the comparison array
+    if njit is not None:
+        return firstIndexAboveKernel(values, thresholds, times, notFound)
+
+    aboveThreshold = values > thresholds[:, np.newaxis]
+
+    # argmax gives the first True in each row (or 0 if there are none)
+    firstIndices = np.argmax(aboveThreshold, axis = 1)
+    rowIndices = np.arange(len(values))
+
+    return np.where(aboveThreshold[rowIndices, firstIndices], times[rowIndices, firstIndices], notFound)
+
+# compiled version of firstIndexAbove, with the rows split between threads
+if njit is not None:
+    @njit(cache = True, parallel = True)
+    def firstIndexAboveKernel(values, thresholds, times, notFound):
+
+        results = np.empty(values.shape[0])
+
+        for row in prange(values.shape[0]):
+            results[row] = notFound
+            for i in range(values.shape[1]):
+                if values[row, i] > thresholds[row]:
+                    results[row] = times[row, i]
+                    break
+
+        return results
+
 # return absolute value of the real fast Fourier Transform
 # def fft(arrList):
 #     return abs(np.fft.rfft(arrList[1]))
@@ -1047,6 +1839,13 @@ def envelopeThresholdTOF(arrList, threshold = 0.1):
 # Returns an array of the same length as input. Values within longWindow-1 of the start of the array will be converted to NaNs
 # NOTE: windows are left-handed in this implementation
 def stalta(array, shortWindow, longWindow):
+
+    # the compiled version keeps running sums of the squared values, so the squared array and the two moving averages
+    #   are not stored as separate arrays
+    if njit is not None:
+        values = np.asarray(array, dtype = np.float64)
+        return staltaKernel(values.reshape(-1, values.shape[-1]), shortWindow, longWindow).reshape(values.shape)
+
     # Calculate square of array values
     arrSquared = array ** 2
 
@@ -1056,6 +1855,73 @@ def stalta(array, shortWindow, longWindow):
 
     return sta / lta
 
+# compiled version of stalta for a 2D array, with the rows split between threads
+# the STA and LTA are running sums of the squared values. Values before both windows are full are NaN, like bn.move_mean
+# NaN samples are counted instead of summed, so only the values whose windows contain a NaN are NaN
+if njit is not None:
+    @njit(cache = True, parallel = True, error_model = 'numpy')
+    def staltaKernel(values, shortWindow, longWindow):
+
+        results = np.empty(values.shape)
+        firstFull = max(shortWindow, longWindow) - 1
+
+        for row in prange(values.shape[0]):
+            y = values[row]
+            staSum = 0.0
+            ltaSum = 0.0
+            staNans = 0
+            ltaNans = 0
+            for i in range(y.size):
+                square = y[i] * y[i]
+                if np.isnan(square):
+                    staNans += 1
+                    ltaNans += 1
+                else:
+                    staSum += square
+                    ltaSum += square
+                if i >= shortWindow:
+                    square = y[i - shortWindow] * y[i - shortWindow]
+                    if np.isnan(square):
+                        staNans -= 1
+                    else:
+                        staSum -= square
+                if i >= longWindow:
+                    square = y[i - longWindow] * y[i - longWindow]
+                    if np.isnan(square):
+                        ltaNans -= 1
+                    else:
+                        ltaSum -= square
+                if i >= firstFull and staNans == 0 and ltaNans == 0:
+                    results[row, i] = (staSum / shortWindow) / (ltaSum / longWindow)
+                else:
+                    results[row, i] = np.nan
+
+        return results
+
+# Calculate the envelope of a signal (the magnitude of its analytic signal, as np.abs(scipy.signal.hilbert(array)))
+#   along the last axis
+# Only the hilbert transform (the imaginary part of the analytic signal) is calculated, with a real FFT, and the envelope
+#   is sqrt(array^2 + transform^2). This skips the full complex inverse FFT and complex analytic signal used by scipy.signal.hilbert
+def analyticEnvelope(array):
+
+    length = array.shape[-1]
+
+    # the hilbert transform multiplies the positive frequencies by -j, and removes the DC and Nyquist frequencies
+    spectrum = scipy.fft.rfft(array, axis = -1)
+    spectrum *= -1j
+    spectrum[..., 0] = 0
+    if length % 2 == 0:
+        spectrum[..., -1] = 0
+
+    envelope = scipy.fft.irfft(spectrum, length, axis = -1)
+
+    # the envelope is computed in place in the hilbert transform array (faster than np.hypot)
+    envelope *= envelope
+    envelope += array * array
+    np.sqrt(envelope, out = envelope)
+
+    return envelope
+
 # generate a grid of coordinates compatible with pixel isolating functions
 # inputs one of the corners of the grid, the length in both dimensions, and the steps between points in both dimensions
 # outputs a list of x and y coordinates
@@ -1072,9 +1938,11 @@ def generateCoordinateGrid(corner, lengths, steps):
     yPts = math.floor(abs(yStop - yStart)/steps[1]) + 1
     yLinspace = np.linspace(yStart, yStop, yPts)
 
-    x, y = np.meshgrid(xLinspace, yLinspace)
+    # same order as the flattened np.meshgrid(xLinspace, yLinspace), without building the 2D grids first
+    x = np.tile(xLinspace, yPts)
+    y = np.repeat(yLinspace, xPts)
 
-    return x.flatten(), y.flatten()
+    return x, y
 
 ######################################################################
 #### DEPRECATED CODE GRAVEYARD #################################
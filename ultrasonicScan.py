@@ -33,15 +33,8 @@ def runScan(params):
     pico = picoscope.Picoscope(params, pulser)
     scanner = sc.Scanner(params)
 
-    # Adjust pulser pulsewidth
-    pulser.setFrequency(params['transducerFrequency'])
-
-    # Set the number of half cycles if using tone burst pulser
-    if pulser.type == 'tone burst':
-        pulser.setHalfCycles(params['halfCycles'])
-
-    # Turn on the pulser
-    pulser.pulserOn()
+    # Adjust pulser pulsewidth, set the number of half cycles if using tone burst pulser, and turn on the pulser
+    pulser.applySetup(params['transducerFrequency'], params['halfCycles'])
 
     #Calculate number of steps on each axis
     #math.ceiling is used to ensure the result is an integer
@@ -52,6 +45,14 @@ def runScan(params):
     # Initialize the collection index which is used in the saved data table
     collectionIndex = 0
 
+    # Look up the parameters used inside the scan loop once, since they are fixed for the whole scan
+    primaryAxis = params['primaryAxis']
+    secondaryAxis = params['secondaryAxis']
+    primaryAxisStep = params['primaryAxisStep']
+    secondaryAxisStep = params['secondaryAxisStep']
+    fileName = params['fileName']
+    saveSqlite = params['saveFormat'] == 'sqlite'
+
     #start scan. tqdm adds progress bars
     for i in tqdm(range(secondaryAxisSteps)):
 
@@ -66,42 +67,44 @@ def runScan(params):
             collectionIndex += 1
 
             #calculate location to add to file
-            iLoc = i * params['secondaryAxisStep']
-            jLoc = j * params['primaryAxisStep']
-
-            iKey = params['secondaryAxis']
-            jKey = params['primaryAxis']
+            iLoc = i * secondaryAxisStep
+            jLoc = j * primaryAxisStep
 
             #add location to pixelData
-            pixelData[iKey] = iLoc
-            pixelData[jKey] = jLoc
+            pixelData[secondaryAxis] = iLoc
+            pixelData[primaryAxis] = jLoc
 
             # save data as sqlite database
-            if params['saveFormat'] == 'sqlite':
-                database.writeData(pixelData)
+            # data is queued and written at the end of each line of the scan
+            if saveSqlite:
+                database.queueData(pixelData)
 
             # save format is json, so dump data, then dump metadata
             else:
                 #write data to json for redundancy
-                with open(params['fileName'], 'a') as file:
+                with open(fileName, 'a') as file:
                     json.dump(pixelData, file)
                     file.write('\n')
 
             #Increment position along primary axis
-            scanner.move(params['primaryAxis'], params['primaryAxisStep'])
+            scanner.move(primaryAxis, primaryAxisStep)
+
 
+        # write the data from this line of the scan
+        if saveSqlite:
+            database.flushData()
 
         # Move back to origin of primary axis
-        scanner.move(params['primaryAxis'], -1 * primaryAxisSteps * params['primaryAxisStep'])
+        scanner.move(primaryAxis, -1 * primaryAxisSteps * primaryAxisStep)
 
         # Increment position on secondary axis
-        scanner.move(params['secondaryAxis'], params['secondaryAxisStep'])
+        scanner.move(secondaryAxis, secondaryAxisStep)
 
-        # Wait 2 seconds for motion to finish
-        time.sleep(2)
+        # Wait for motion to finish
+        scanner.waitForMoves()
 
     #Return to the start position. Only needs to be done on the secondary axis since the parimary axis resets at the end of the loop
-    scanner.move(params['secondaryAxis'], -1 * secondaryAxisSteps * params['secondaryAxisStep'])
+    scanner.move(secondaryAxis, -1 * secondaryAxisSteps * secondaryAxisStep)
 
     #Turn off pulser
     pulser.pulserOff()
@@ -114,7 +117,7 @@ def runScan(params):
         multiplexer.closeMux()
 
     if params['saveFormat'] == 'sqlite':
-        database.connection.close()
+        database.close()
         if params['postAnalysis']:
             pj.simplePostAnalysis(params)
 
@@ -88,14 +88,8 @@ class Pulser():
     def setFrequency(self, freq):
 
         if self.type == 'standard':
-            # Calculate pulse width from frequency. First convert freq to period (in ns) then divide by 2 -> 500 / freq
-            # math.floor is used to find the nearest integer
-            pulseWidth = math.floor(500 / freq)
 
-            # Convert the pulseWidth to the appropriate pulser command
-            pulseWidthCommand = 'W' + str(pulseWidth)
-
-            self.writeToPulser(pulseWidthCommand)
+            self.writeToPulser(self.pulseWidthCommand(freq))
 
         elif self.type == "tone burst":
 
@@ -106,6 +100,17 @@ class Pulser():
             # send command
             self.connection.setFrequency(freqkhz)
 
+    # Converts a frequency in MHz into the W (pulse width) command of the standard pulser
+    # Used by setFrequency and applySetup
+    @staticmethod
+    def pulseWidthCommand(freq):
+
+        # Calculate pulse width from frequency. First convert freq to period (in ns) then divide by 2 -> 500 / freq
+        # math.floor is used to find the nearest integer
+        pulseWidth = math.floor(500 / freq)
+
+        return 'W' + str(pulseWidth)
+
     def setHalfCycles(self, halfCycles : int):
 
         if self.type == 'standard':
@@ -122,6 +127,26 @@ class Pulser():
             else:
                 print("pulser.setHalfCycles: parameter 'halfCycles' must be an integer between 1 and 32")
 
+    # Sets the frequency and (for the tone burst pulser) the half cycles, then turns the pulser on
+    # Equivalent to calling setFrequency, setHalfCycles, and pulserOn but sends everything in a single message
+    #   standard - the W and P commands are joined into one serial write
+    #   tone burst - all three SDK calls are made in one request to the 32-bit server
+    # Inputs a frequency in MHz and the number of half cycles (ignored for the standard pulser)
+    def applySetup(self, freq, halfCycles = None):
+
+        if self.type == 'standard':
+            # P500 turns the pulser on at max PRF (see pulserOn)
+            self.writeToPulser(self.pulseWidthCommand(freq) + '\rP500')
+
+        elif self.type == 'tone burst':
+
+            if halfCycles is not None and not (1 <= halfCycles and halfCycles <= 32):
+                print("pulser.applySetup: parameter 'halfCycles' must be an integer between 1 and 32. Half cycles will not be changed")
+                halfCycles = None
+
+            freqkhz = math.floor(freq * 1000)
+            self.connection.applySetup(freqkhz, halfCycles, 1000)
+
     # Turns the pulser on at maximum pulse repitition frequency (PRF)
     # Returns None
     def pulserOn(self):
@@ -213,6 +238,9 @@ class usbut350Client(Client64):
     def setHalfCycles(self, halfCycles = 16):
         return self.request32('setHalfCycles', halfCycles)
 
+    def applySetup(self, freq, halfCycles = None, prf = 1000):
+        return self.request32('applySetup', freq, halfCycles, prf)
+
     # incomplete version, just sets to max voltage
     # TODO: implement actual selection
     def setVoltage(self):
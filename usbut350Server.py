@@ -70,6 +70,18 @@ class usbut350Server(Server32):
 
         return self.lib.USBUTParms(1012, self.usbPort, halfCycles)
 
+    # Sets the frequency (in kHz), half cycles, and PRF in a single request from the client
+    # Saves two round trips between the 64-bit client and this server compared to calling each function separately
+    # halfCycles = None leaves the half cycles unchanged
+    def applySetup(self, freq, halfCycles = None, prf = 1000):
+
+        self.setFrequency(freq)
+
+        if halfCycles is not None:
+            self.setHalfCycles(halfCycles)
+
+        return self.setPRF(prf)
+
     # For now this function just sets voltage to max
     # TODO: translate the formula in SDK to make this usable
     def setVoltage(self):